@@ -0,0 +1,42 @@
+""" Finding bags to ingest in the catalog and S3, and staging them for the DSpace import """
+import pytest
+
+from dspaceq.tasks.tasks import dspace_ingest
+from dspaceq.tasks.utils import get_digitized_bags, get_mmsid, list_s3_files, list_s3_files_batch
+
+from conftest import make_bag_names, make_digital_objects, put_bag
+
+
+def bench_get_digitized_bags(benchmark, fake_mongo):
+    digital_objects = fake_mongo.catalog.digital_objects
+    digital_objects.insert_many(make_digital_objects(5000))
+    digital_objects.create_index("mmsid")
+    mmsids = [get_mmsid(bag) for bag in make_bag_names(5000)[::10]]
+    bags = benchmark(get_digitized_bags, mmsids)
+    assert len(bags) == len([index for index in range(0, 5000, 10) if index % 4])  # skips ingested bags
+
+
+@pytest.fixture()
+def s3_bags(fake_s3):
+    bags = make_bag_names(20)
+    return {bag: put_bag(fake_s3, bag) for bag in bags}
+
+
+def bench_list_s3_files(benchmark, s3_bags):
+    bag = sorted(s3_bags)[0]
+    files = benchmark(list_s3_files, bag)
+    assert sorted(files) == sorted(s3_bags[bag])
+
+
+def bench_list_s3_files_batch(benchmark, s3_bags):
+    files = benchmark(list_s3_files_batch, list(s3_bags))
+    assert sum(len(keys) for keys in files.values()) == 7 * len(s3_bags)
+
+
+def bench_dspace_ingest_staging(benchmark, s3_bags, fake_dspace):
+    """ download, SAF layout and mapfile handling for 20 bags of 5 x 64KB pdfs """
+    bag_details = [{bag: {"files": [key for key in keys if key.endswith(".pdf")],
+                          "metadata": "<dublin_core><dcvalue element='title'>{0}</dcvalue></dublin_core>".format(bag)}}
+                   for bag, keys in sorted(s3_bags.items())]
+    result = benchmark(dspace_ingest, bag_details, "11244/23528")
+    assert sorted(result["success"]) == sorted(s3_bags)
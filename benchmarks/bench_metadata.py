@@ -0,0 +1,42 @@
+""" Alma record handling - bag name parsing, MARC to dublin core and metadata checks """
+import pytest
+
+from dspaceq.tasks.utils import get_mmsid, bib_to_dc, missing_fields, guess_collection, get_bib_records, \
+    reload_xml_resources
+
+from conftest import make_bag_names
+
+
+@pytest.fixture(scope="module")
+def bags():
+    return make_bag_names(1000)
+
+
+def bench_get_mmsid(benchmark, bags):
+    mmsids = benchmark(lambda: [get_mmsid(bag) for bag in bags])
+    assert len(set(mmsids)) == len(bags)
+
+
+def bench_bib_to_dc(benchmark, bib_records):
+    reload_xml_resources()  # compile the XSLT and schema outside of the timings
+    records = list(bib_records.values())[:50]
+    dc = benchmark(lambda: [bib_to_dc(record) for record in records])
+    assert all(b"dublin_core" in record for record in dc)
+
+
+def bench_missing_fields(benchmark, bib_records):
+    records = list(bib_records.values())
+    missing = benchmark(lambda: [missing_fields(record) for record in records])
+    assert missing == [[]] * len(records)
+
+
+def bench_guess_collection(benchmark, bib_records):
+    records = list(bib_records.values())
+    collections = benchmark(lambda: [guess_collection(record) for record in records])
+    assert set(collections) == {"11244/23528"}
+
+
+def bench_get_bib_records(benchmark, fake_alma, bib_records):
+    mmsids = list(bib_records)
+    records = benchmark(get_bib_records, mmsids, cache=False)
+    assert all(mmsid.encode() in records[mmsid] for mmsid in mmsids)
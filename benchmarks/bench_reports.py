@@ -0,0 +1,18 @@
+""" Embargo report against a DSpace database of 5000 items """
+from dspaceq.tasks.reports import report_embargoed_items
+
+
+def bench_report_embargoed_items(benchmark, fake_postgres):
+    rows = benchmark(report_embargoed_items, "2019-09-01", "2019-12-31")
+    assert rows and all(row[1].startswith("Author") for row in rows)
+
+
+def bench_report_embargoed_items_collections(benchmark, fake_postgres):
+    rows = benchmark(report_embargoed_items, "2019-09-01", "2019-12-31", collections=["11244/c1", "11244/c2"])
+    assert rows
+
+
+def bench_report_embargoed_items_stream(benchmark, fake_postgres, tmpdir):
+    output = str(tmpdir / "embargo.csv")
+    result = benchmark(report_embargoed_items, "2019-01-01", "2020-12-31", output=output, yield_per=500)
+    assert result["rows"] > 1000
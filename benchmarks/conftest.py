@@ -0,0 +1,277 @@
+"""
+Synthetic data generators and local stand-ins for the services dspaceq talks to
+
+  Alma      - a threaded HTTP server answering the /bibs API from generated MARC records
+  S3        - moto
+  Mongo     - mongomock as the celery result backend's client
+  Postgres  - an in-memory sqlite database holding the DSpace tables used by the embargo report
+  DSpace    - a fake `dspace import` process that writes the mapfile
+"""
+import datetime
+import os
+import random
+import re
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+import boto3
+import pytest
+import sqlalchemy
+from lxml import etree
+
+from dspaceq.tasks import reports, tasks, utils
+
+DATA = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "data")
+BUCKET = "benchmark-bucket"
+
+
+# ------------------------------------ generators ------------------------------------
+
+def make_mmsid(index):
+    """ returns an Alma style mmsid - record type prefix, sequence, institution suffix """
+    return "99{0:09d}02042".format(index)
+
+
+def make_bag_names(count):
+    return ["Author{0}_{1}_{2}".format(index, 1950 + index % 70, make_mmsid(index)) for index in range(count)]
+
+
+def make_bib_record(mmsid, subjects=25, contents_notes=10, seed=None):
+    """ returns a bib record like the Alma API's, grown to a realistic thesis record size (~15KB)
+
+        The example record has a 502 thesis note, 690 school and subject headings added so it is complete
+    """
+    rng = random.Random(seed if seed is not None else mmsid)
+    bib = etree.parse(os.path.join(DATA, "example_bib_record.xml")).getroot()
+    bib.find("mms_id").text = mmsid
+    record = bib.find("record")
+    record.find("controlfield[@tag='001']").text = mmsid
+
+    def datafield(tag, **subfields):
+        field = etree.SubElement(record, "datafield", ind1=" ", ind2="0", tag=tag)
+        for code, text in sorted(subfields.items()):
+            etree.SubElement(field, "subfield", code=code).text = text
+
+    words = ["analysis", "petroleum", "geology", "education", "history", "oklahoma", "policy", "chemistry",
+             "engineering", "literature", "microbiology", "statistics", "water", "energy", "culture"]
+    datafield("502", a="Thesis (M.S.)--University of Oklahoma, {0}.".format(1950 + rng.randint(0, 70)))
+    datafield("690", a="University of Oklahoma. School of {0}".format(rng.choice(words).title()))
+    for _ in range(subjects):
+        datafield("650", a=" ".join(rng.choice(words) for _ in range(3)).title(), x="Research", z="Oklahoma")
+    for _ in range(contents_notes):
+        datafield("505", a=" -- ".join(" ".join(rng.choice(words) for _ in range(6)) for _ in range(8)))
+    return etree.tostring(bib, encoding="UTF-8", xml_declaration=True, standalone=True)
+
+
+@pytest.fixture(scope="session")
+def bib_records():
+    """ {mmsid: bib record} for 200 generated records """
+    return {make_mmsid(index): make_bib_record(make_mmsid(index)) for index in range(200)}
+
+
+# ------------------------------------ Alma ------------------------------------
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _AlmaHandler(BaseHTTPRequestHandler):
+    """ answers GET /almaws/v1/bibs?mms_id=... and PUT /almaws/v1/bibs/{mmsid} """
+    protocol_version = "HTTP/1.1"  # keep-alive, as Alma does
+
+    def _send(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        mmsids = parse_qs(url.query).get("mms_id", [""])[0].split(",")
+        bibs = etree.Element("bibs", total_record_count="0")
+        for mmsid in mmsids:
+            if mmsid in self.server.records:
+                bibs.append(etree.fromstring(self.server.records[mmsid]))
+        bibs.set("total_record_count", str(len(bibs)))
+        self._send(200, etree.tostring(bibs, encoding="UTF-8", xml_declaration=True))
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._send(200, b"<bib/>")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="session")
+def alma_server(bib_records):
+    """ local HTTP stand-in for the Alma bibs API serving the generated bib records """
+    server = _ThreadingHTTPServer(("127.0.0.1", 0), _AlmaHandler)
+    server.records = bib_records
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:{0}/almaws/v1/bibs".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture()
+def fake_alma(alma_server, monkeypatch):
+    """ points the Alma client at the local stand-in without rate limiting or caching """
+    monkeypatch.setattr(utils, "alma_bibs_url", alma_server + "?mms_id={0}&expand=None&apikey={1}")
+    monkeypatch.setattr(utils, "alma_url", alma_server + "/{0}?expand=None&apikey={1}")
+    monkeypatch.setattr(tasks, "alma_url", alma_server + "/{0}?expand=None&apikey={1}")
+    monkeypatch.setattr(utils, "alma_rate_limiter", utils.TokenBucket(rate=10 ** 6))
+    utils.bib_cache.clear()
+    yield alma_server
+    utils.bib_cache.clear()
+
+
+# ------------------------------------ S3 ------------------------------------
+
+@pytest.fixture()
+def fake_s3(monkeypatch):
+    """ moto S3 with the default bucket created """
+    from moto import mock_s3
+    for name, value in [("AWS_ACCESS_KEY_ID", "testing"), ("AWS_SECRET_ACCESS_KEY", "testing"),
+                        ("AWS_DEFAULT_REGION", "us-east-1"), ("DEFAULT_BUCKET", BUCKET)]:
+        monkeypatch.setenv(name, value)
+    with mock_s3():
+        utils.reset_s3_client()
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+    utils.reset_s3_client()
+
+
+def put_bag(s3_client, bag, files=5, size=64 * 1024):
+    """ uploads a bag of pdfs plus committee.txt and abstract.txt and returns its data keys """
+    keys = []
+    prefix = "private/shareok/{0}/data/".format(bag)
+    for index in range(files):
+        keys.append(prefix + "chapter_{0}.pdf".format(index))
+        s3_client.put_object(Bucket=BUCKET, Key=keys[-1], Body=os.urandom(size))
+    for name, body in [("committee.txt", "Jane Smith\nJohn Doe"), ("abstract.txt", "An abstract. " * 100)]:
+        keys.append(prefix + name)
+        s3_client.put_object(Bucket=BUCKET, Key=keys[-1], Body=body)
+    return keys
+
+
+# ------------------------------------ Mongo ------------------------------------
+
+@pytest.fixture()
+def fake_mongo(monkeypatch):
+    """ mongomock client used as the celery result backend's database client """
+    import mongomock
+    client = mongomock.MongoClient()
+
+    class Backend(object):
+        class database(object):
+            pass
+    Backend.database.client = client
+    monkeypatch.setattr(utils.Celery, "backend", Backend)
+    yield client
+
+
+def make_digital_objects(count, ingested_every=4):
+    """ catalog.digital_objects documents for count bags - every ingested_every'th already ingested """
+    return [{"bag": "shareok/{0}".format(bag),
+             "mmsid": utils.get_mmsid(bag),
+             "locations": {"s3": {"exists": True}},
+             "application": {"dspace": {"ingested": index % ingested_every == 0}}}
+            for index, bag in enumerate(make_bag_names(count))]
+
+
+# ------------------------------------ Postgres ------------------------------------
+
+_DSPACE_TABLES = """
+create table handle (handle text, resource_id integer);
+create table item2bundle (item_id integer, bundle_id integer);
+create table bundle2bitstream (bundle_id integer, bitstream_id integer);
+create table resourcepolicy (dspace_object integer, start_date date);
+create table collection2item (collection_id integer, item_id integer);
+create table metadatavalue (dspace_object_id integer, metadata_field_id integer, text_value text);
+create index resourcepolicy_start_date_idx on resourcepolicy (start_date);
+create index metadatavalue_object_idx on metadatavalue (dspace_object_id);
+"""
+
+
+def make_embargo_engine(items, collections=10, seed=1):
+    """ returns an in-memory sqlite engine with the DSpace tables used by the embargo report
+
+        Each item has one bundle of three bitstreams with resource policies starting in 2019-2020
+    """
+    rng = random.Random(seed)
+    engine = sqlalchemy.create_engine("sqlite://", poolclass=sqlalchemy.pool.StaticPool,
+                                      connect_args={"check_same_thread": False})
+    with engine.begin() as conn:
+        for statement in _DSPACE_TABLES.strip().split(";"):
+            if statement.strip():
+                conn.execute(sqlalchemy.text(statement))
+        collection_offset = 10 ** 6
+        conn.execute(sqlalchemy.text("insert into handle values (:handle, :resource_id)"),
+                     [{"handle": "11244/c{0}".format(c), "resource_id": collection_offset + c} for c in range(collections)])
+        handles, bundles, bitstreams, policies, members, metadata = [], [], [], [], [], []
+        for item in range(items):
+            handles.append({"handle": "11244/{0}".format(item), "resource_id": item})
+            bundles.append({"item_id": item, "bundle_id": item})
+            members.append({"collection_id": collection_offset + item % collections, "item_id": item})
+            for bitstream in range(3):
+                bitstream_id = item * 3 + bitstream
+                bitstreams.append({"bundle_id": item, "bitstream_id": bitstream_id})
+                start = datetime.date(2019, 1, 1) + datetime.timedelta(days=rng.randint(0, 730))
+                policies.append({"dspace_object": bitstream_id, "start_date": start})
+            for field, value in [(reports.AUTHOR, "Author {0}".format(item)), (reports.URI, "11244/{0}".format(item)),
+                                 (reports.TITLE, "Title {0}".format(item)), (reports.DEPARTMENT, "Department")]:
+                metadata.append({"dspace_object_id": item, "metadata_field_id": field, "text_value": value})
+        conn.execute(sqlalchemy.text("insert into handle values (:handle, :resource_id)"), handles)
+        conn.execute(sqlalchemy.text("insert into item2bundle values (:item_id, :bundle_id)"), bundles)
+        conn.execute(sqlalchemy.text("insert into bundle2bitstream values (:bundle_id, :bitstream_id)"), bitstreams)
+        conn.execute(sqlalchemy.text("insert into resourcepolicy values (:dspace_object, :start_date)"), policies)
+        conn.execute(sqlalchemy.text("insert into collection2item values (:collection_id, :item_id)"), members)
+        conn.execute(sqlalchemy.text("insert into metadatavalue values (:dspace_object_id, :metadata_field_id, :text_value)"), metadata)
+    return engine
+
+
+@pytest.fixture(scope="session")
+def embargo_engine():
+    return make_embargo_engine(items=5000)
+
+
+@pytest.fixture()
+def fake_postgres(embargo_engine, monkeypatch):
+    """ the embargo report reads the sqlite stand-in """
+    monkeypatch.setattr(reports, "_engine", embargo_engine)
+    yield embargo_engine
+
+
+# ------------------------------------ DSpace ------------------------------------
+
+class _FakeImport(object):
+    """ stands in for `dspace import` - writes a mapfile line for each SAF item and exits """
+    returncode = 0
+
+    def __init__(self, args, **kwargs):
+        source_dir = args[args.index("-s") + 1]
+        items = sorted(item for item in os.listdir(source_dir) if re.match(r"item_\d+$", item))
+        with open(args[args.index("-m") + 1], "w") as f:
+            f.write("".join("{0} 11244/{1}\n".format(item, index) for index, item in enumerate(items)))
+
+    def poll(self):
+        return self.returncode
+
+
+@pytest.fixture()
+def fake_dspace(monkeypatch):
+    monkeypatch.setattr(tasks, "Popen", _FakeImport)
+    yield _FakeImport
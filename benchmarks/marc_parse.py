@@ -0,0 +1,56 @@
+"""
+Micro-benchmark of the bib record to dublin core pipeline
+
+Compares validating MARC by serializing and reparsing the record through a schema bound parser
+with validating the parsed tree in place, reporting xml parses and time per record.
+
+usage (with dspaceq installed): python benchmarks/marc_parse.py [records]
+"""
+from __future__ import print_function
+import os
+import sys
+from timeit import default_timer
+
+from lxml import etree
+
+from dspaceq.tasks.utils import get_marc_from_bib, get_xml_resource, marc_xml_to_dc_xml, validate_marc, MARC21_XSD
+
+BIB_RECORD = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "data", "example_bib_record.xml")
+
+
+def reparse_validate(marc_xml):
+    """ the previous validate_marc - serialize and reparse through a schema bound parser """
+    parser = etree.XMLParser(schema=get_xml_resource(MARC21_XSD))
+    return etree.fromstring(etree.tostring(marc_xml), parser)
+
+
+def run(validate, bib_record, records):
+    """ returns (parses per record, seconds per record) converting bib_record to dc """
+    parses = [0]
+    fromstring = etree.fromstring
+
+    def counting_fromstring(*args, **kwargs):
+        parses[0] += 1
+        return fromstring(*args, **kwargs)
+
+    etree.fromstring = counting_fromstring
+    try:
+        start = default_timer()
+        for _ in range(records):
+            etree.tostring(marc_xml_to_dc_xml(validate(get_marc_from_bib(bib_record))))
+        elapsed = default_timer() - start
+    finally:
+        etree.fromstring = fromstring
+    return parses[0] / float(records), elapsed / records
+
+
+def main(records=1000):
+    bib_record = open(BIB_RECORD, "rb").read()
+    get_xml_resource(MARC21_XSD)  # compile outside of the timings
+    for name, validate in (("serialize/reparse", reparse_validate), ("in-tree", validate_marc)):
+        parses, seconds = run(validate, bib_record, records)
+        print("{0:<18} parses/record: {1:.1f}  ms/record: {2:.3f}".format(name, parses, seconds * 1000))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1 +1,2 @@
-alma_url = "https://api-na.hosted.exlibrisgroup.com/almaws/v1/bibs/{0}?expand=None&apikey={1}"
\ No newline at end of file
+alma_url = "https://api-na.hosted.exlibrisgroup.com/almaws/v1/bibs/{0}?expand=None&apikey={1}"
+alma_bibs_url = "https://api-na.hosted.exlibrisgroup.com/almaws/v1/bibs?mms_id={0}&expand=None&apikey={1}"
@@ -0,0 +1,212 @@
+from celery import Task
+from contextlib import contextmanager
+from functools import wraps
+from timeit import default_timer
+
+import logging
+import os
+import socket
+import threading
+
+try:
+    import celeryconfig
+except ImportError:
+    logging.error("Failed to import celeryconfig")
+    celeryconfig = None
+
+# optional celeryconfig settings
+TASK_TIMINGS = getattr(celeryconfig, "TASK_TIMINGS", False)  # add a "timings" summary to dict task results
+STAGE_METRICS_DIR = getattr(celeryconfig, "STAGE_METRICS_DIR", None)  # prometheus textfile collector directory
+STAGE_METRICS_STATSD = getattr(celeryconfig, "STAGE_METRICS_STATSD", None)  # "host:port" of a statsd server
+STAGE_METRICS_PREFIX = "dspaceq"
+
+_lock = threading.Lock()
+_totals = {}  # {stage: [count, seconds, bytes]} for the life of the worker process
+_context = threading.local()  # bag of the enclosing span and the StageTimings of the task running in this thread
+
+
+class StageTimings(object):
+    """ durations, counts and bytes recorded per stage and per bag """
+    def __init__(self):
+        self.stages = {}  # {stage: [count, seconds, bytes]}
+        self.bags = {}  # {bag: {stage: [count, seconds, bytes]}}
+
+    @staticmethod
+    def _add(stages, stage, seconds, count, nbytes):
+        totals = stages.setdefault(stage, [0, 0.0, 0])
+        totals[0] += count
+        totals[1] += seconds
+        totals[2] += nbytes
+
+    def add(self, stage, seconds, count=1, nbytes=0, bag=None):
+        self._add(self.stages, stage, seconds, count, nbytes)
+        if bag is not None:
+            self._add(self.bags.setdefault(bag, {}), stage, seconds, count, nbytes)
+
+    def summary(self):
+        """ returns {"stages": {stage: {"count", "seconds", "bytes"}}, "bags": {bag: {stage: {...}}}} """
+        with _lock:
+            return {"stages": _format(self.stages),
+                    "bags": {bag: _format(stages) for bag, stages in self.bags.items()}}
+
+
+def _format(stages):
+    return {stage: {"count": count, "seconds": round(seconds, 6), "bytes": nbytes}
+            for stage, (count, seconds, nbytes) in stages.items()}
+
+
+def current_bag():
+    """ returns the bag of the enclosing span in this thread """
+    return getattr(_context, "bag", None)
+
+
+def current_collectors():
+    """ returns the StageTimings collecting for the task running in this thread """
+    return getattr(_context, "collectors", ())
+
+
+def bound_to_bag(func):
+    """ returns func wrapped to run with the current bag and task timings
+
+        Spans in worker threads then keep their bag and are only collected by the task that started them
+    """
+    bag = current_bag()
+    collectors = current_collectors()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = current_bag(), current_collectors()
+        _context.bag, _context.collectors = bag, collectors
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _context.bag, _context.collectors = previous
+    return wrapper
+
+
+def record_stage(stage, seconds, count=1, nbytes=0, bag=None):
+    """ adds a measurement to the process totals and the timings of the task running in this thread """
+    bag = bag if bag is not None else current_bag()
+    with _lock:
+        StageTimings._add(_totals, stage, seconds, count, nbytes)
+        for timings in current_collectors():
+            timings.add(stage, seconds, count, nbytes, bag)
+
+
+@contextmanager
+def span(stage, bag=None, nbytes=0):
+    """ times the enclosed block as a stage
+
+        Yields a dict whose "bytes" may be updated within the block.
+        Spans nested in the same thread are attributed to the bag of the enclosing span.
+    """
+    previous = current_bag()
+    bag = bag if bag is not None else previous
+    _context.bag = bag
+    measurement = {"bytes": nbytes}
+    start = default_timer()
+    try:
+        yield measurement
+    finally:
+        _context.bag = previous
+        record_stage(stage, default_timer() - start, nbytes=measurement["bytes"], bag=bag)
+
+
+def timed(stage):
+    """ decorator timing each call of a function as a stage """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def collect_timings():
+    """ yields the StageTimings recorded in this thread, and threads running bound_to_bag functions, while the block runs
+
+        Other tasks running in the same process (thread or green pools) are not included
+    """
+    timings = StageTimings()
+    previous = current_collectors()
+    _context.collectors = previous + (timings,)
+    try:
+        yield timings
+    finally:
+        _context.collectors = previous
+
+
+class TimedTask(Task):
+    """ task base class - collects stage timings while the task runs and exports them
+
+        When TASK_TIMINGS is set the summary is added to dict results as "timings".
+        Timing in __call__ rather than a decorator keeps the task's signature for celery's argument checks.
+    """
+    def __call__(self, *args, **kwargs):
+        with collect_timings() as timings:
+            try:
+                result = super(TimedTask, self).__call__(*args, **kwargs)
+            finally:
+                summary = timings.summary()
+                export_stage_metrics(summary)  # failed runs are exported too
+        if TASK_TIMINGS and isinstance(result, dict):
+            result["timings"] = summary
+        return result
+
+
+def get_stage_totals():
+    """ returns the stage totals of the worker process """
+    with _lock:
+        return _format(_totals)
+
+
+def reset_stage_totals():
+    with _lock:
+        _totals.clear()
+
+
+def _write_prometheus_textfile(directory, totals):
+    """ writes the process totals for the prometheus node exporter textfile collector """
+    lines = []
+    for metric, field, help_text in (("seconds", "seconds", "Seconds spent in each ingest stage"),
+                                     ("calls", "count", "Calls of each ingest stage"),
+                                     ("bytes", "bytes", "Bytes transferred by each ingest stage")):
+        name = "{0}_stage_{1}_total".format(STAGE_METRICS_PREFIX, metric)
+        lines.append("# HELP {0} {1}".format(name, help_text))
+        lines.append("# TYPE {0} counter".format(name))
+        for stage in sorted(totals):
+            lines.append('{0}{{stage="{1}",pid="{2}"}} {3}'.format(name, stage, os.getpid(), totals[stage][field]))
+    path = os.path.join(directory, "{0}_{1}.prom".format(STAGE_METRICS_PREFIX, os.getpid()))
+    with open(path + ".tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.rename(path + ".tmp", path)  # the collector never reads a partial file
+
+
+def _send_statsd(address, stages):
+    """ sends a task's stage timings to statsd as timers and counters """
+    host, port = address.rsplit(":", 1)
+    lines = []
+    for stage, values in sorted(stages.items()):
+        name = "{0}.stage.{1}".format(STAGE_METRICS_PREFIX, stage)
+        lines.append("{0}.seconds:{1:.3f}|ms".format(name, values["seconds"] * 1000))
+        lines.append("{0}.calls:{1}|c".format(name, values["count"]))
+        if values["bytes"]:
+            lines.append("{0}.bytes:{1}|c".format(name, values["bytes"]))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto("\n".join(lines).encode("utf-8"), (host, int(port)))
+    finally:
+        sock.close()
+
+
+def export_stage_metrics(summary):
+    """ exports a task summary to statsd and the process totals to a prometheus textfile, if configured """
+    try:
+        if STAGE_METRICS_STATSD and summary["stages"]:
+            _send_statsd(STAGE_METRICS_STATSD, summary["stages"])
+        if STAGE_METRICS_DIR:
+            _write_prometheus_textfile(STAGE_METRICS_DIR, get_stage_totals())
+    except Exception as e:
+        logging.error("Could not export stage metrics: {0}".format(e))
@@ -1,7 +1,18 @@
 from celery import Celery
+from celery.signals import worker_process_init
 
+import csv
+import io
+import json
 import logging
+import os
 import re
+import threading
+from collections import defaultdict, OrderedDict
+from tempfile import mkstemp
+from six import PY2, ensure_binary, ensure_text, text_type
+
+from .utils import chunk_list, get_s3_client
 
 logging.basicConfig(level=logging.INFO)
 
@@ -17,12 +28,18 @@ except ImportError:
     logging.error("Failed to import variables from celeryconfig")
     DB_USERNAME = DB_PASSWORD = DB_NAME = DB_HOST = DB_PORT = None
 
+# connection pool settings - optional celeryconfig settings
+DB_POOL_SIZE = getattr(celeryconfig, "DB_POOL_SIZE", 5)
+DB_MAX_OVERFLOW = getattr(celeryconfig, "DB_MAX_OVERFLOW", 5)
+DB_POOL_PRE_PING = getattr(celeryconfig, "DB_POOL_PRE_PING", True)
+REPORT_YIELD_PER = getattr(celeryconfig, "REPORT_YIELD_PER", 1000)  # rows per server side cursor fetch when streaming
+
 app = Celery()
 app.config_from_object(celeryconfig)
 
 import sqlalchemy
 from sqlalchemy.engine.url import URL
-from sqlalchemy import create_engine, text
+from sqlalchemy import bindparam, create_engine, text
 
 pg_db = {
     'drivername': 'postgresql',
@@ -33,43 +50,67 @@ pg_db = {
     'port': DB_PORT
 }
 
-startdate_query = """
-  select * from (
-    select handle, item_id, max(start_date) as max_date
-    from handle
-    join item2bundle on item2bundle.item_id = handle.resource_id
-    join bundle2bitstream on bundle2bitstream.bundle_id = item2bundle.bundle_id
-    join resourcepolicy on resourcepolicy.dspace_object = bundle2bitstream.bitstream_id
-    group by handle.handle, item2bundle.item_id
-    having handle in (
-      select distinct(handle)
-      from handle
-      join item2bundle on item2bundle.item_id = handle.resource_id
-      join bundle2bitstream on bundle2bitstream.bundle_id = item2bundle.bundle_id
-      join resourcepolicy on resourcepolicy.dspace_object = bundle2bitstream.bitstream_id
-      where resourcepolicy.start_date >= :beg_date
-      and resourcepolicy.start_date <= :end_date
-    )
-  ) as embargos
-  where embargos.max_date >= :beg_date
-  and embargos.max_date <= :end_date;
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """ returns the dspace database engine shared by all reports, creating it on first use """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(URL.create(**pg_db), pool_size=DB_POOL_SIZE,
+                                    max_overflow=DB_MAX_OVERFLOW, pool_pre_ping=DB_POOL_PRE_PING)
+        return _engine
+
+
+@worker_process_init.connect
+def reset_engine(**kwargs):
+    """ replace the connection pool inherited from the parent so forked workers do not share connections """
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose(close=False)
+
+
+# Items whose latest resource policy start date (end of embargo) falls within the date range.
+# Policies starting before beg_date cannot change whether max(start_date) is in range, so they are
+# filtered out before aggregating, which lets Postgres use an index on resourcepolicy.start_date.
+_startdate_query = """
+  select handle.handle, item2bundle.item_id, max(resourcepolicy.start_date) as max_date
+  from handle
+  join item2bundle on item2bundle.item_id = handle.resource_id
+  join bundle2bitstream on bundle2bitstream.bundle_id = item2bundle.bundle_id
+  join resourcepolicy on resourcepolicy.dspace_object = bundle2bitstream.bitstream_id{collection_join}
+  where resourcepolicy.start_date >= :beg_date{collection_filter}
+  group by handle.handle, item2bundle.item_id
+  having max(resourcepolicy.start_date) <= :end_date;
+"""
+
+startdate_query = _startdate_query.format(collection_join="", collection_filter="")
+
+# limit to items in the collections with the supplied handles
+startdate_collection_query = _startdate_query.format(
+    collection_join="""
+  join collection2item on collection2item.item_id = item2bundle.item_id
+  join handle as collection_handle on collection_handle.resource_id = collection2item.collection_id""",
+    collection_filter="""
+  and collection_handle.handle in :collections""")
+
+# Indexes supporting startdate_query - compare plans with report_embargoed_items(..., explain=True)
+startdate_index_advice = """
+  create index if not exists resourcepolicy_start_date_idx on resourcepolicy (start_date) where start_date is not null;
+  create index if not exists resourcepolicy_dspace_object_idx on resourcepolicy (dspace_object);
+  create index if not exists bundle2bitstream_bitstream_id_idx on bundle2bitstream (bitstream_id);
+  create index if not exists collection2item_item_id_idx on collection2item (item_id);
 """
 
 metadata_query = """
-    select metadata_field_id, text_value
+    select dspace_object_id, metadata_field_id, text_value
     from metadatavalue
-    where dspace_object_id = :item_id
+    where dspace_object_id in :item_ids
     and metadata_field_id in :fields;
 """
 
-collection_query = """
-  select handle, item_id from handle
-    join collection on handle.resource_id = collection.uuid
-    join collection2item on collection2item.collection_id = collection.uuid
-    where handle.handle in :handles
-    and collection2item.item_id in :item_ids;
-"""
-
 
 # Metadata field values in DSpace
 AUTHOR = 3
@@ -78,9 +119,16 @@ TITLE = 64
 ALTERNATIVE_TITLE = 65
 DEPARTMENT = 103
 
+METADATA_CHUNK_SIZE = 1000  # items per metadata query
+
+
+def _statement(query, *expanding):
+    """ returns a text statement whose list parameters are expanded by sqlalchemy rather than the dbapi """
+    return text(query).bindparams(*[bindparam(name, expanding=True) for name in expanding])
+
 
 @app.task()
-def report_embargoed_items(beg_date, end_date, collections=None):
+def report_embargoed_items(beg_date, end_date, collections=None, explain=False, output=None, yield_per=None):
     """
     Report details regarding items coming out of embargo in the selected date range
     Returns list of list: [[handle, author, title, dept/college, date],]
@@ -89,6 +137,12 @@ def report_embargoed_items(beg_date, end_date, collections=None):
        beg_date (string): 'YYYY-MM-DD'
        end_date (string): 'YYYY-MM-DD'
        collections [string]: ['11244/#####', ...] optional - limits results to specified collection handle(s)
+       explain (boolean): return the EXPLAIN ANALYZE plan of the embargo query instead of the report
+                          see startdate_index_advice for supporting indexes
+       output (string): optional - stream rows to a local file or 's3://bucket/key' instead of returning them
+                        and return {"output": output, "rows": row count}
+                        outputs ending in .csv are written as CSV, anything else as JSON lines
+       yield_per (int): optional - rows to fetch from the server side cursor at a time when streaming
     """
     
     # regular expression to match YYYY-MM-DD
@@ -101,30 +155,60 @@ def report_embargoed_items(beg_date, end_date, collections=None):
 
     # TODO: check that end_date is greater than beg_date
     try:
-        engine = create_engine(URL.create(**pg_db))
-        conn = engine.connect()
+        conn = get_engine().connect()
     except sqlalchemy.exc.OperationalError as e:
         logging.error("Error with DB connection (from dspaceq/reports)\n{0}".format(e))
         return {"ERROR": "Issue connecting to database, try again in a few minutes"}
 
+    with conn:  # return the connection to the pool when finished
+        return _report_embargoed_items(conn, beg_date, end_date, collections, explain, output, yield_per)
+
+
+def _report_embargoed_items(conn, beg_date, end_date, collections, explain=False, output=None, yield_per=None):
+    """ runs the embargo report queries on a checked out connection """
+    if collections:
+        query = startdate_collection_query
+        params = {"beg_date": beg_date, "end_date": end_date, "collections": tuple(collections)}
+    else:
+        query = startdate_query
+        params = {"beg_date": beg_date, "end_date": end_date}
+    expanding = ["collections"] if collections else []
+    if explain:
+        statement = _statement("explain analyze " + query, *expanding)
+    else:
+        # typed so drivers that return dates as strings (sqlite) still give dates
+        statement = _statement(query, *expanding).columns(max_date=sqlalchemy.Date)
     try:
-        res_items = conn.execute(text(startdate_query), beg_date=beg_date, end_date=end_date).fetchall()
+        if output and not explain:
+            res_items = conn.execution_options(stream_results=True).execute(statement, **params)
+        else:
+            res_items = conn.execute(statement, **params).fetchall()
     except sqlalchemy.exc.DataError as e:
         logging.error("Potential sql injection attempt\n{0}".format(e))
         return {"ERROR": "Could not process supplied dates"}
 
-    if collections and list(res_items):  # do not perform if res_items is empty
-        item_ids = tuple(item[1] for item in res_items)
-        handles = tuple(collections)
-        res_collection = conn.execute(text(collection_query), handles=handles, item_ids=item_ids).fetchall()
-        item_ids_in_collections = {item[1] for item in res_collection}
+    if explain:
+        return {"plan": [row[0] for row in res_items]}
+    if output:
+        return _stream_report(conn, res_items, output, yield_per or REPORT_YIELD_PER)
+    return _report_rows(conn, res_items)
+
+
+def _report_rows(conn, res_items):
+    """ returns report rows for (handle, item_id, max_date) results """
+    # fetch metadata for all items in as few queries as possible and pivot into {item_id: {field: value}}
+    metadata_statement = _statement(metadata_query, "item_ids", "fields")
+    item_ids = list(OrderedDict.fromkeys(item[1] for item in res_items))
+    metadata = defaultdict(dict)
+    for chunk in chunk_list(item_ids, METADATA_CHUNK_SIZE):
+        res_meta = conn.execute(metadata_statement, item_ids=tuple(chunk), fields=(AUTHOR, URI, TITLE, DEPARTMENT)).fetchall()
+        for item_id, field_id, value in res_meta:
+            metadata[item_id][field_id] = value
 
     results = []
     for item in res_items:
         handle, item_id, start_date = item
-        if collections and item_id not in item_ids_in_collections:
-            continue  #skip item if it is not in one of the defined collections
-        res_meta = dict(conn.execute(text(metadata_query), item_id=item_id, fields=(AUTHOR, URI, TITLE, DEPARTMENT)).fetchall())
+        res_meta = metadata[item_id]
         results.append(
             [handle, 
              res_meta.get(AUTHOR, "Unknown"),
@@ -135,3 +219,41 @@ def report_embargoed_items(beg_date, end_date, collections=None):
         )
     return results
 
+
+def _row_writer(f, as_csv):
+    """ returns a function writing one report row to f - python 2 csv needs a byte file and utf-8 values """
+    if not as_csv:
+        return lambda row: f.write(ensure_text(json.dumps(row)) + "\n")
+    writer = csv.writer(f)
+    if PY2:
+        return lambda row: writer.writerow([ensure_binary(value) if isinstance(value, text_type) else value for value in row])
+    return writer.writerow
+
+
+def _stream_report(conn, result, output, yield_per):
+    """ writes report rows to output one server side cursor partition at a time """
+    if output.startswith("s3://"):
+        fd, filename = mkstemp(prefix="dspaceq_report_")
+        os.close(fd)
+    else:
+        filename = output
+    as_csv = output.lower().endswith(".csv")
+    rows = 0
+    try:
+        if PY2 and as_csv:
+            f = io.open(filename, "wb")
+        else:
+            f = io.open(filename, "w", newline="", encoding="utf-8")
+        with f:
+            write_row = _row_writer(f, as_csv)
+            for partition in result.partitions(yield_per):
+                for row in _report_rows(conn, partition):
+                    write_row(row)
+                    rows += 1
+        if output.startswith("s3://"):
+            bucket, key = output[len("s3://"):].split("/", 1)
+            get_s3_client().upload_file(filename, bucket, key)
+    finally:
+        if filename != output:
+            os.remove(filename)
+    return {"output": output, "rows": rows}
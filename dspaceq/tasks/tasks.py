@@ -2,22 +2,28 @@ from tempfile import mkdtemp
 from shutil import rmtree
 from os.path import join, isfile
 from os import mkdir
-from subprocess import check_call, CalledProcessError, check_output, STDOUT
+from subprocess import Popen
 
-from celery import signature, group, Celery
-from inspect import cleandoc
-from collections import defaultdict
+from celery import signature, group, chord, Celery
+from celery.signals import worker_ready
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
 from lxml import etree
 from six import ensure_text
 
 import boto3
+import datetime
 import logging
 import requests
 import jinja2
+import threading
+import time
 
 from .utils import *
 from .config import alma_url
+from .instrument import span, bound_to_bag, TimedTask, get_stage_totals
 
 logging.basicConfig(level=logging.INFO)
 
@@ -35,9 +41,36 @@ except ImportError:
     ALMA_KEY = ALMA_RW_KEY = ETD_NOTIFICATION_EMAIL = ALMA_NOTIFICATION_EMAIL = REST_ENDPOINT = ""
     IR_NOTIFICATION_EMAIL = QUEUE_NAME = DSPACE_BINARY = DSPACE_FQDN = ""
 
+ALMA_UPDATE_WORKERS = getattr(celeryconfig, "ALMA_UPDATE_WORKERS", 8)  # concurrent Alma record updates
+DSPACE_IMPORT_CHUNK_SIZE = getattr(celeryconfig, "DSPACE_IMPORT_CHUNK_SIZE", 0)  # bags per dspace import - 0 imports all at once
+DSPACE_IMPORT_WORKERS = getattr(celeryconfig, "DSPACE_IMPORT_WORKERS", 2)  # concurrent dspace imports of chunks
+DSPACE_IMPORT_POLL = getattr(celeryconfig, "DSPACE_IMPORT_POLL", 2)  # seconds between reads of a running import's output
+DSPACE_LOG_TAIL = 50  # lines of the import log printed when an import fails
+CATALOG_BACKFILL_INTERVAL = getattr(celeryconfig, "CATALOG_BACKFILL_INTERVAL", 3600)  # seconds between celery beat runs of backfill_digital_object_mmsids - 0 leaves it unscheduled
+# seconds between celery beat runs of send_alma_url_digest, which mails the queued Alma URL changes
+# 0 mails a digest per update_alma_url_field invocation instead of queueing
+ALMA_DIGEST_WINDOW = getattr(celeryconfig, "ALMA_DIGEST_WINDOW", 0)
+
 app = Celery()
 app.config_from_object(celeryconfig)
 
+
+def _schedule(name, task, seconds):
+    """ adds a periodic task to the celery beat schedule unless celeryconfig already schedules it """
+    schedule = dict(app.conf.beat_schedule or {})
+    entry = {"task": task, "schedule": seconds}
+    if QUEUE_NAME:
+        entry["options"] = {"queue": QUEUE_NAME}
+    schedule.setdefault(name, entry)
+    app.conf.beat_schedule = schedule
+
+
+# Email templates in dspaceq/tasks/templates - compiled once per process and cached as bytecode on disk
+templates = jinja2.Environment(
+    loader=jinja2.PackageLoader("dspaceq.tasks", "templates"),
+    bytecode_cache=jinja2.FileSystemBytecodeCache(getattr(celeryconfig, "TEMPLATE_CACHE_DIR", None)),
+)
+
 s3_bucket = 'ul-bagit'
 #s3_bucket=os.getenv('DEFAULT_BUCKET','ul-bagit')
 
@@ -52,8 +85,122 @@ def add(x, y):
     result = x + y
     return result
 
-@app.task()
-def dspace_ingest(bag_details, collection, notify_email="libir@ou.edu"):
+def _make_shared_dir(path):
+    """ creates a directory within a shared directory """
+    mkdir(path)
+    share_dir(path)
+
+
+def _write_shared_file(path, text):
+    """ writes a file that is readable and writable by DSPACE_GROUP """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, DSPACE_FILE_MODE)
+    os.fchmod(fd, DSPACE_FILE_MODE)  # not limited by the worker's umask
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+
+
+def _write_saf_item(bag_dir, bag_args):
+    """ writes the contents file and metadata files of a DSpace Simple Archive Format item """
+    filenames = [file.split("/")[-1] for file in bag_args["files"]]
+    _write_shared_file(join(bag_dir, "contents"), "\n".join(filenames))
+    _write_shared_file(join(bag_dir, "dublin_core.xml"), ensure_text(bag_args["metadata"]))
+    for attrib in bag_args:
+        if "metadata_" in attrib:
+            _write_shared_file(join(bag_dir, attrib), ensure_text(bag_args[attrib]))
+
+
+class _FileTail(object):
+    """ reads the complete lines appended to a file since the previous read """
+    def __init__(self, path):
+        self.path = path
+        self.position = 0
+        self.partial = b""
+
+    def read(self, final=False):
+        """ returns new lines - final also returns a last line without a newline """
+        if not isfile(self.path):
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(self.position)
+            data = f.read()
+            self.position = f.tell()
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        if final and self.partial:
+            lines.append(self.partial)
+            self.partial = b""
+        return [line.decode("utf-8", "replace") for line in lines]
+
+
+def _import_saf(source_dir, collection, notify_email, item_match, progress=None):
+    """ runs dspace import on a directory of SAF items and returns [(bag, handle)] read from its mapfile
+
+        The import log and mapfile are read while the import runs - progress(bag, handle) is
+        called as each item appears in the mapfile
+    """
+    results = []
+    log_path = '{0}/ds_ingest_log.txt'.format(source_dir)
+    log = _FileTail(log_path)
+    log_tail = deque(maxlen=DSPACE_LOG_TAIL)
+    mapfile = _FileTail('{0}/mapfile'.format(source_dir))
+
+    def read_output(final=False):
+        for line in log.read(final):
+            logging.debug("dspace import: {0}".format(line))
+            log_tail.append(line)
+        for row in mapfile.read(final):
+            if row:
+                item_index, handle = row.split(" ")
+                results.append((item_match[item_index], handle))
+                if progress:
+                    progress(item_match[item_index], handle)
+
+    with open(log_path, "w") as f, span("dspace_import"):
+        process = Popen(["sudo", "-u", "tomcat", DSPACE_BINARY, "import", "-a", "-e", notify_email, "-c", collection.encode('ascii', 'ignore'), "-s", source_dir, "-m", ('{0}/mapfile'.format(source_dir))], stderr=f, stdout=f)
+        try:
+            while process.poll() is None:
+                read_output()
+                time.sleep(DSPACE_IMPORT_POLL)
+            read_output(final=True)
+        except BaseException:
+            if process.poll() is None:
+                process.kill()
+            raise
+    if process.returncode != 0:
+        print("\n".join(log_tail))
+        print("Error: dspace import exited with status {0}".format(process.returncode))
+        raise FailedIngest("failed to ingest")
+    return results
+
+
+def _ingest_chunk(s3_client, s3_bucket, chunk_dir, items, collection, notify_email, progress=None, downloads=None):
+    """ downloads and imports one chunk of bags
+
+        args: chunk_dir (string); directory to build the SAF items in
+              items [(index, bag_details item)]; bags in the chunk with their position in bag_details
+              downloads (ThreadPoolExecutor); download pool shared by concurrent chunks
+        returns [(bag, handle)]
+    """
+    item_match = {} #lookup to match item in mapfile to bag
+    bag_files = {}
+    bag_metadata = {}
+    for index, bag in items:
+        item_match["item_{0}".format(index)] = list(bag.keys())[0]
+        bag_dir = join(chunk_dir, "item_{0}".format(index))
+        bag_args = list(bag.values())[0]
+        _make_shared_dir(bag_dir)
+        bag_files[bag_dir] = bag_args["files"]
+        bag_metadata[bag_dir] = bag_args
+
+    # write the SAF item layout for each bag once all of its files have been downloaded
+    bag_names = {join(chunk_dir, item): bag for item, bag in item_match.items()}
+    for bag_dir in download_s3_bags(s3_client, s3_bucket, bag_files, names=bag_names, executor=downloads):
+        _write_saf_item(bag_dir, bag_metadata[bag_dir])
+    return _import_saf(chunk_dir, collection, notify_email, item_match, progress)
+
+
+@app.task(bind=True, base=TimedTask)
+def dspace_ingest(self, bag_details, collection, notify_email="libir@ou.edu", chunk_size=None):
     """ Generates temporary directory and url for the bags to be downloaded from
         S3, prior to ingest into DSpace, then performs the ingest
 
@@ -62,11 +209,17 @@ def dspace_ingest(bag_details, collection, notify_email="libir@ou.edu"):
                                    will determine from Alma
               dspace_endpoint (string); url to shareok / commons API endpoint
               - example: https://test.shareok.org/rest
+              chunk_size (int); bags per dspace import - defaults to DSPACE_IMPORT_CHUNK_SIZE
+                                0 imports all bags at once
+        returns: {"success": {bag: url}}
+                 chunked imports also include "failed": {bag: error} for bags in chunks that failed,
+                 and raise FailedIngest only if every chunk fails
+        While the import runs the task state is PROGRESS with meta
+            {"imported": items imported, "total": items, "current": last imported bag,
+             "elapsed": seconds, "items_per_second": rate}
     """
 
-    item_match = {} #lookup to match item in mapfile to bag
     tempdir = mkdtemp(prefix="dspaceq_")
-    results = []
     
     s3 = boto3.resource("s3")
     s3_bucket=os.getenv('DEFAULT_BUCKET','ul-bagit')
@@ -74,57 +227,64 @@ def dspace_ingest(bag_details, collection, notify_email="libir@ou.edu"):
     if type(bag_details) != list:
         bag_details = [bag_details]
 
-    '''download files and metadata indicated by bag_details'''
-    for index, bag in enumerate(bag_details):
-        item_match["item_{0}".format(index)] = list(bag.keys())[0]
-        bag_dir = join(tempdir, "item_{0}".format(index))
-        bag_args = list(bag.values())[0]
-        mkdir(bag_dir)
-        if type(bag) == dict:
-            files = bag_args["files"]
-            for file in files:
-                filename = file.split("/")[-1]
-                s3.Bucket(s3_bucket).download_file(file, join(bag_dir, filename))
-            with open(join(bag_dir, "contents"),"w") as f:
-                filenames = [file.split("/")[-1] for file in files]
-                f.write("\n".join(filenames))
-            with open(join(bag_dir, "dublin_core.xml"), "w") as f:
-                f.write(ensure_text(bag_args["metadata"]))
-            for attrib in bag_args:
-                if "metadata_" in attrib:
-                    with open(join(bag_dir, attrib), "w") as f:
-                        f.write(ensure_text(bag_args[attrib]))
-        else:
-            print('The submitted item for bag ingest does not match format', bag)
-            results.append(bag, "Failed to ingest-check submitted formatting")
-
+    chunk_size = DSPACE_IMPORT_CHUNK_SIZE if chunk_size is None else chunk_size
+    items = list(enumerate(bag_details))
+
+    started = time.time()
+    imported = []
+    progress_lock = threading.Lock()
+
+    def progress(bag, handle):
+        with progress_lock:
+            imported.append(bag)
+            elapsed = time.time() - started
+            logging.info("Imported {0} as {1} ({2}/{3})".format(bag, handle, len(imported), len(items)))
+            if self.request.id:
+                self.update_state(state="PROGRESS", meta={
+                    "imported": len(imported), "total": len(items), "current": bag,
+                    "elapsed": round(elapsed, 1), "items_per_second": round(len(imported) / elapsed, 3) if elapsed else None})
     try:
-        check_call(["chmod", "-R", "0775", tempdir])
-        check_call(["chgrp", "-R", "tomcat", tempdir])
-        with open('{0}/ds_ingest_log.txt'.format(tempdir), "w") as f:
-            check_call(["sudo", "-u", "tomcat", DSPACE_BINARY, "import", "-a", "-e", notify_email, "-c", collection.encode('ascii', 'ignore'), "-s", tempdir, "-m", ('{0}/mapfile'.format(tempdir))], stderr=f, stdout=f)
-        with open('{0}/mapfile'.format(tempdir)) as f:
-            for row in f.read().split('\n'):
-                if row:
-                    item_index, handle = row.split(" ")
-                    results.append((item_match[item_index], handle))
-    except CalledProcessError as e:
-        exists = isfile('{0}/ds_ingest_log.txt'.format(tempdir))
-        if exists:
-            with open('{0}/ds_ingest_log.txt'.format(tempdir), "r") as f:
-                print(f.read())
-        print("Error: {0}".format(e))
-        raise FailedIngest("failed to ingest")
+        share_dir(tempdir, dspace_gid())
+        if not chunk_size or len(items) <= chunk_size:
+            results = _ingest_chunk(s3.meta.client, s3_bucket, tempdir, items, collection, notify_email, progress)
+            return({"success": {item[0]:"{0}{1}".format(DSPACE_FQDN, item[1]) for item in results}})
+
+        # import each chunk with its own mapfile so a failure only affects the bags in that chunk
+        # chunks share one download pool so S3_DOWNLOAD_WORKERS stays the limit for the whole task
+        chunks = {}
+        with ThreadPoolExecutor(max_workers=S3_DOWNLOAD_WORKERS) as downloads, \
+                ThreadPoolExecutor(max_workers=DSPACE_IMPORT_WORKERS) as executor:
+            for index, chunk in enumerate(chunk_list(items, chunk_size)):
+                chunk_dir = join(tempdir, "chunk_{0}".format(index))
+                _make_shared_dir(chunk_dir)
+                future = executor.submit(bound_to_bag(_ingest_chunk), s3.meta.client, s3_bucket, chunk_dir, chunk, collection, notify_email, progress, downloads)
+                chunks[future] = (chunk_dir, chunk)
+            status = {"success": {}, "failed": {}}
+            for future, (chunk_dir, chunk) in chunks.items():
+                try:
+                    for bag, handle in future.result():
+                        status["success"][bag] = "{0}{1}".format(DSPACE_FQDN, handle)
+                except Exception as e:
+                    logging.error("Failed to ingest {0}: {1}".format(chunk_dir, e))
+                    for index, bag in chunk:
+                        status["failed"][list(bag.keys())[0]] = "failed to ingest"
+                finally:
+                    rmtree(chunk_dir, ignore_errors=True)
+        if not status["success"]:
+            raise FailedIngest("failed to ingest")
+        return status
     finally:
         rmtree(tempdir)
-    return({"success": {item[0]:"{0}{1}".format(DSPACE_FQDN, item[1]) for item in results}})
 
 
-@app.task()
+@app.task(base=TimedTask)
 def ingest_thesis_dissertation(bag="", collection="",): #dspace_endpoint=REST_ENDPOINT):
     """
     Ingest a bagged thesis or dissertation into dspace
 
+    Bags with complete Alma records have their metadata prepared in parallel by prepare_etd_bag
+    tasks, then ingest_prepared_etds starts the ingest of each collection
+
     args:
        bag (string); Name of bag to ingest - if blank, will ingest all non-ingested items
        collection (string); dspace collection id to load into - if blank, will determine from Alma
@@ -132,100 +292,162 @@ def ingest_thesis_dissertation(bag="", collection="",): #dspace_endpoint=REST_EN
 
     if bag == "":
         # Ingest requested items (bags) not yet ingested
-        bags = get_digitized_bags([etd['mmsid'] for etd in get_requested_etds(".*")])
+        bags = get_digitized_bags(get_requested_mmsids())
     else:
         bags = [bag]
 
     if bags == []:
         return "No items found ready for ingest"
 
-    s3 = boto3.resource("s3")
-    s3_bucket=os.getenv('DEFAULT_BUCKET','ul-bagit')
-
-
-    collections = defaultdict(list)
-
     failed = {}
-    good_bags = []
+    bib_records = get_bib_records([get_mmsid(bag) for bag in bags])
+    ready_bags = []
     for bag in bags:
-        if check_missing(get_mmsid(bag))[0][1] != []:
+        if check_missing(get_mmsid(bag), bib_records)[0][1] != []:
             failed[bag] = "Missing required metadata in Alma - contact cataloging group"
-            continue  #skip to next bag
+        else:
+            ready_bags.append(bag)
+
+    if ready_bags == []:
+        return {"Kicked off ingest": [], "failed": failed}
+
+    bag_files = list_s3_files_batch(ready_bags)
+    prepare = group([
+        signature(
+            "dspaceq.tasks.tasks.prepare_etd_bag",
+            queue=QUEUE_NAME,
+            kwargs={"bag": bag,
+                    "collection": collection,
+                    "files": bag_files[bag],
+                    "bib_record": bib_records.get(get_mmsid(bag))
+                    }
+        ) for bag in ready_bags])
+    kickoff = signature(
+        "dspaceq.tasks.tasks.ingest_prepared_etds",
+        queue=QUEUE_NAME,
+        kwargs={"failed": failed}
+    )
+    chord(prepare)(kickoff)
+    return {"Kicked off ingest": ready_bags, "failed": failed}
 
+
+@app.task(base=TimedTask)
+def prepare_etd_bag(bag, collection="", files=None, bib_record=None):
+    """
+    Prepares the dublin core metadata and file list used to ingest a bag
+    This is called by the ingest_thesis_dissertation task
+
+    args:
+       bag (string); Name of bag
+       collection (string); dspace collection id to load into - if blank, will determine from Alma
+       files [string]; s3 keys of the bag files - listed from s3 if not provided
+       bib_record (string); Alma bib record - fetched from Alma if not provided
+    returns:
+       {"bag": bag, "collection": collection, "files": [...], "metadata": dc xml}
+       or {"bag": bag, "error": message}
+    """
+    try:
+        with span("prepare", bag=bag):
+            return _prepare_etd_bag(bag, collection, files, bib_record)
+    except Exception as e:
+        # report the failure for this bag rather than failing the whole chord
+        logging.exception("Failed to prepare {0}".format(bag))
+        return {"bag": bag, "error": "Failed to prepare metadata: {0}".format(e)}
+
+
+def _prepare_etd_bag(bag, collection, files, bib_record):
+    s3_bucket=os.getenv('DEFAULT_BUCKET','ul-bagit')
+
+    if files is None:
         files = list_s3_files(bag)
-        logging.debug("Using files: {0}".format(files))
-
-        mmsid = get_mmsid(bag)
-        bib_record = get_bib_record(mmsid)
-        
-        # Remove 590 tags from marc bib record
-        marc_xml = get_marc_from_bib(bib_record).getroot()
-        found_elements = marc_xml.xpath("datafield[@tag=590]")
-        for element in found_elements:
-            marc_xml.remove(element)
-        namespaced_marc_xml = validate_marc(marc_xml)
-        logging.debug(namespaced_marc_xml)
-
-        dc_xml_element = marc_xml_to_dc_xml(namespaced_marc_xml).getroot()
-        logging.debug(dc_xml_element)
-        # Remove duplicate "date created" fields
-        results = dc_xml_element.xpath("//dublin_core/dcvalue[@element='date' and @qualifier='created']")
-        for result in results[1:]:
-            dc_xml_element.remove(result)
-        new_file_list = []
-        error_in_file = False 
-        for file in files:
-            if 'committee.txt' in file.lower():
-                obj = s3.Object(s3_bucket, file)
-                committee = obj.get()['Body'].read().decode('utf-8')
-             # If committee.txt is present, add contents to dc metadata
-                if committee:
-                    for committee_member in committee.split("\n"):
-                        try:
-                            c = etree.Element("dcvalue", element='contributor', qualifier='committeeMember')
-                            c.text = committee_member
-                            dc_xml_element.insert(0, c)
-                        except ValueError:
-                            logging.error("Incompatible character found in committee.txt for {0}".format(bag))
-                            failed[bag] = "Incompatible character found in committee.txt"
-                            error_in_file = True
-                            break
-                    if error_in_file:
-                        break  # break out of file handling loop
-            elif 'abstract.txt' in file.lower():
-            # If abstract.txt is present, add contents to dc metadata
-                obj = s3.Object(s3_bucket, file)
-                abstract = obj.get()['Body'].read().decode('utf-8')
-                if abstract:
+    logging.debug("Using files: {0}".format(files))
+
+    mmsid = get_mmsid(bag)
+    if bib_record is None:
+        bib_record = get_bib_records([mmsid]).get(mmsid)
+    if bib_record is None or type(bib_record) is dict:  # If this is a dictionary, we failed to get a valid bib_record
+        logging.error("failed to get bib_record for: {0}".format(bag))
+        return {"bag": bag, "error": bib_record or "Could not find record!"}
+
+    # Remove 590 tags from marc bib record
+    marc_xml = get_marc_from_bib(bib_record).getroot()
+    found_elements = marc_xml.xpath("datafield[@tag=590]")
+    for element in found_elements:
+        marc_xml.remove(element)
+    namespaced_marc_xml = validate_marc(marc_xml)
+    logging.debug(namespaced_marc_xml)
+
+    dc_xml_element = marc_xml_to_dc_xml(namespaced_marc_xml).getroot()
+    logging.debug(dc_xml_element)
+    # Remove duplicate "date created" fields
+    results = dc_xml_element.xpath("//dublin_core/dcvalue[@element='date' and @qualifier='created']")
+    for result in results[1:]:
+        dc_xml_element.remove(result)
+    # fetch committee.txt and abstract.txt together before adding them to the dc metadata
+    sidecars = [file for file in files if 'committee.txt' in file.lower() or 'abstract.txt' in file.lower()]
+    try:
+        texts = read_s3_texts(sidecars, s3_bucket)
+    except S3ObjectTooLarge as e:
+        logging.error("{0} exceeds size limit for {1}".format(e, bag))
+        return {"bag": bag, "error": "{0} exceeds size limit".format(str(e).split("/")[-1])}
+    new_file_list = []
+    for file in files:
+        if 'committee.txt' in file.lower():
+            committee = texts[file]
+            # If committee.txt is present, add contents to dc metadata
+            if committee:
+                for committee_member in committee.split("\n"):
                     try:
-                        a = etree.Element("dcvalue", element='description', qualifier='abstract')
-                        a.text = abstract
-                        dc_xml_element.insert(0, a)
+                        c = etree.Element("dcvalue", element='contributor', qualifier='committeeMember')
+                        c.text = committee_member
+                        dc_xml_element.insert(0, c)
                     except ValueError:
-                        logging.error("Incompatible character found in abstract.txt for {0}".format(bag))
-                        failed[bag] = "Incompatible character found in abstract.txt"
-                        error_in_file = True
-                        break
-            else:
-                new_file_list.append(file)
-        if error_in_file:
-            continue  # skip to next bag
-        dc = etree.tostring(dc_xml_element)
-        files = new_file_list
-        if collection == "":
-            if type(bib_record) is not dict: #If this is a dictionary, we failed to get a valid bib_record
-                collections[guess_collection(bib_record)].append({bag: {"files": files, "metadata": dc}})
-            else:
-                logging.error("failed to get bib_record to determine collection for: {0}".format(bag))
-                failed[bag] = bib_record  # failed - pass along error message
+                        logging.error("Incompatible character found in committee.txt for {0}".format(bag))
+                        return {"bag": bag, "error": "Incompatible character found in committee.txt"}
+        elif 'abstract.txt' in file.lower():
+            # If abstract.txt is present, add contents to dc metadata
+            abstract = texts[file]
+            if abstract:
+                try:
+                    a = etree.Element("dcvalue", element='description', qualifier='abstract')
+                    a.text = abstract
+                    dc_xml_element.insert(0, a)
+                except ValueError:
+                    logging.error("Incompatible character found in abstract.txt for {0}".format(bag))
+                    return {"bag": bag, "error": "Incompatible character found in abstract.txt"}
         else:
-            collections[collection].append({bag: {"files": files, "metadata": dc}})
-        
+            new_file_list.append(file)
+    dc = etree.tostring(dc_xml_element)
+    if collection == "":
+        collection = guess_collection(bib_record)
+    return {"bag": bag, "collection": collection, "files": new_file_list, "metadata": dc}
+
+
+@app.task()
+def ingest_prepared_etds(prepared, failed=None):
+    """
+    Groups prepared bags by collection and starts the ingest of each collection
+    This is the chord callback of the ingest_thesis_dissertation task
+
+    args:
+       prepared [dict]; results of prepare_etd_bag tasks
+       failed (dict); {bag: message} for bags that were not prepared
+    """
+    failed = dict(failed or {})
+    collections = defaultdict(list)
+    good_bags = []
+    for result in prepared:
+        bag = result["bag"]
+        if result.get("error"):
+            failed[bag] = result["error"]
+            continue
+        collections[result["collection"]].append({bag: {"files": result["files"], "metadata": result["metadata"]}})
         good_bags.append(bag)
-        
+
     update_alma = signature(
         "dspaceq.tasks.tasks.update_alma_url_field",
-        queue=QUEUE_NAME
+        queue=QUEUE_NAME,
+        kwargs={"digest": True}
     )
     update_datacatalog = signature(
         "dspaceq.tasks.tasks.update_datacatalog",
@@ -257,32 +479,19 @@ def notify_etd_missing_fields():
     Sends email to collections to notify of missing fields in Alma
     for requested Theses and Disertations
     """
-    emailtmplt = r"""
-    The following ETD requests have missing fields:
-    The bags are accessible on norfile: ul-bagit\shareok\*
-    {% for bag in bags %}========================
-      bag: {{ bag }}
-      mmsid: {{ bags[bag].mmsid }}
-      Missing Details:{% for field in bags[bag].missing %}
-        {{ field }}{% endfor %}
-    {% endfor %}
-    """
 
     mmsids = get_requested_mmsids()
     digitized_bags = list(get_digitized_bags(mmsids))
     digitized_mmsids = [get_mmsid(bag) for bag in digitized_bags]
-    missing = [item for item in check_missing(digitized_mmsids) if item[1] != []]
+    missing = {mmsid: items for mmsid, items in check_missing(digitized_mmsids) if items != []}
     bags_missing_details = {}
-    for bag in digitized_bags:
-        for mmsid, items in missing:
-            if mmsid in bag:
-                bags_missing_details[bag] = {}
-                bags_missing_details[bag]['mmsid'] = mmsid
-                bags_missing_details[bag]['missing'] = items
+    for bag, mmsid in zip(digitized_bags, digitized_mmsids):
+        if mmsid in missing:
+            bags_missing_details[bag] = {}
+            bags_missing_details[bag]['mmsid'] = mmsid
+            bags_missing_details[bag]['missing'] = missing[mmsid]
     if bags_missing_details:
-        env = jinja2.Environment()
-        tmplt = env.from_string(cleandoc(emailtmplt))
-        msg = tmplt.render(bags=bags_missing_details)
+        msg = templates.get_template("etd_missing_fields.txt").render(bags=bags_missing_details)
         sendmail = signature(
            "emailq.tasks.tasks.sendmail",
            kwargs={
@@ -310,25 +519,12 @@ def notify_dspace_etd_loaded(args):
     print(ingested_items)
     if ingested_items:
         ingested_url_lookup = {get_mmsid(bag): url for bag, url in ingested_items.items()}
-        mmsids_regex = "|".join([get_mmsid(bag) for bag in ingested_items.keys()])
-        request_details = get_requested_etds(mmsids_regex)
+        request_details = get_requested_etds([get_mmsid(bag) for bag in ingested_items.keys()])
         print(request_details)
         for request in request_details:
             request['url'] = ingested_url_lookup[request['mmsid']]
 
-        emailtmplt = r"""
-        The following ETD requests have been loaded into the repository:
-        {% for request in request_details %}========================
-        Requester: {{ request.name }}
-        Email: {{ request.email }}
-        Creator: {{ request.creator }}
-        Year: {{ request.year }}
-        URL: {{ request.url }}
-        {% endfor %}
-        """
-        env = jinja2.Environment()
-        tmplt = env.from_string(cleandoc(emailtmplt))
-        msg = tmplt.render(request_details=request_details)
+        msg = templates.get_template("etd_loaded.txt").render(request_details=request_details)
         print(msg)
         send_mail = signature(
            "emailq.tasks.tasks.sendmail",
@@ -363,8 +559,64 @@ def _update_alma_url_field(bib_record, url):
     return etree.tostring(tree, standalone="yes", encoding="UTF-8")
 
 
+def _put_alma_url_field(bagname, url, bib_record):
+    """ writes url into the Alma record for a bag and returns (bagname, url, previous url, error message) """
+    mmsid = get_mmsid(bagname)
+    if bib_record is None or type(bib_record) is dict:
+        logging.error("Could not access alma")
+        return bagname, url, None, "Could not access alma"
+    old_url = get_alma_url_field(bib_record)
+    new_xml = _update_alma_url_field(bib_record, url)
+    try:
+        with span("alma_update", bag=bagname):
+            update_result = alma_request("PUT", alma_url.format(mmsid, ALMA_RW_KEY),
+                data=new_xml, headers={"content-type": "application/xml"})
+    except Exception as e:
+        logging.error("Could not update record: {0} - {1}".format(mmsid, e))
+        return bagname, url, old_url, "Could not update record"
+    if update_result.status_code != requests.codes.ok:
+        logging.error("Could not update record: {0}".format(mmsid))
+        return bagname, url, old_url, "Could not update record"
+    logging.info("Alma record updated for mmsid: {0}".format(mmsid))
+    bib_cache.invalidate(mmsid)
+    return bagname, url, old_url, None
+
+
+def _send_alma_url_digest(changes):
+    """ sends a single email listing Alma URL changes: [{"mmsid":, "old_url":, "new_url":}] """
+    msg = templates.get_template("alma_url_digest.txt").render(changes=changes)
+    sendmail = signature(
+        "emailq.tasks.tasks.sendmail",
+        kwargs={
+            'to': ALMA_NOTIFICATION_EMAIL,
+            'subject': 'ETD Records Updated - URL ({0})'.format(len(changes)),
+            'body': msg
+        })
+    sendmail.delay()
+    logging.info("Sent Alma notification digest of {0} changes".format(len(changes)))
+
+
 @app.task()
-def update_alma_url_field(args, notify=True):
+def send_alma_url_digest():
+    """
+    Sends one email with the Alma URL changes queued by update_alma_url_field(digest=True)
+    Celery beat runs this every ALMA_DIGEST_WINDOW seconds when the window is set
+    """
+    digest = app.backend.database.client.catalog.alma_url_digest
+    changes = list(digest.find({}).sort("datetime", 1))
+    if not changes:
+        return "No Alma URL changes to send"
+    _send_alma_url_digest(changes)
+    digest.delete_many({"_id": {"$in": [change["_id"] for change in changes]}})
+    return "Sent Alma URL digest of {0} changes".format(len(changes))
+
+
+if ALMA_DIGEST_WINDOW:
+    _schedule("send-alma-url-digest", "dspaceq.tasks.tasks.send_alma_url_digest", ALMA_DIGEST_WINDOW)
+
+
+@app.task(base=TimedTask)
+def update_alma_url_field(args, notify=True, digest=False):
     """
     Updates the Electronic location (tag 856) in Alma with the URL
     This is called by the ingest_thesis_dissertation task
@@ -372,6 +624,8 @@ def update_alma_url_field(args, notify=True):
     args:
        args: {"success": {bagname: url}
        notify (boolean); notify alma team of update - default is true
+       digest (boolean); notify with a single email listing all changes instead of one email per record
+                         if ALMA_DIGEST_WINDOW is set, changes are queued for send_alma_url_digest
     """
 
     """
@@ -384,38 +638,40 @@ def update_alma_url_field(args, notify=True):
     if ingested_items:
         status = {'success': [], 'fail': []}
         msg = "URL(tag 856) for Alma record {0} has been changed\nfrom: {1}\nto: {2}"
-        for bagname, url in ingested_items.items():
-            mmsid = get_mmsid(bagname)
-            result = requests.get(alma_url.format(mmsid, ALMA_KEY))
-            if result.status_code == requests.codes.ok:
-                old_url = get_alma_url_field(result.content)
-                new_xml = _update_alma_url_field(result.content, url)
-                update_result = requests.put(url=alma_url.format(mmsid, ALMA_RW_KEY),
-                    data=new_xml, headers={"content-type": "application/xml"})
-                if update_result.status_code == requests.codes.ok:
-                    logging.info("Alma record updated for mmsid: {0}".format(mmsid))
-                    status['success'].append([bagname, url])
-                    if notify is True:
-                        sendmail = signature(
-                            "emailq.tasks.tasks.sendmail",
-                            kwargs={
-                            'to': ALMA_NOTIFICATION_EMAIL,
-                            'subject': 'ETD Record Updated - URL',
-                            'body': msg.format(mmsid, old_url, url)
-                        })
-                        sendmail.delay()
-                        logging.info("Sent Alma notification email")
-                else:
-                    logging.error("Could not update record: {0}".format(mmsid))
-                    status['fail'].append([bagname, "Could not update record"])
-            else:
-                # TODO: Add retry
-                logging.error("Could not access alma")
-                status['fail'].append([bagname, "Could not access alma"])
+        # fetch current records from Alma - a cached copy could overwrite newer changes
+        bib_records = get_bib_records([get_mmsid(bagname) for bagname in ingested_items], cache=False)
+        with ThreadPoolExecutor(max_workers=ALMA_UPDATE_WORKERS) as executor:
+            updates = list(executor.map(bound_to_bag(
+                lambda item: _put_alma_url_field(item[0], item[1], bib_records.get(get_mmsid(item[0])))),
+                ingested_items.items()))
+        changes = []
+        for bagname, url, old_url, error in updates:
+            if error:
+                status['fail'].append([bagname, error])
+                continue
+            status['success'].append([bagname, url])
+            if notify is True and digest:
+                changes.append({"mmsid": get_mmsid(bagname), "old_url": old_url, "new_url": url,
+                                "datetime": datetime.datetime.utcnow().isoformat()})
+            elif notify is True:
+                sendmail = signature(
+                    "emailq.tasks.tasks.sendmail",
+                    kwargs={
+                    'to': ALMA_NOTIFICATION_EMAIL,
+                    'subject': 'ETD Record Updated - URL',
+                    'body': msg.format(get_mmsid(bagname), old_url, url)
+                })
+                sendmail.delay()
+                logging.info("Sent Alma notification email")
+        if changes and ALMA_DIGEST_WINDOW:
+            app.backend.database.client.catalog.alma_url_digest.insert_many(changes)
+            logging.info("Queued {0} Alma URL changes for digest".format(len(changes)))
+        elif changes:
+            _send_alma_url_digest(changes)
         return status
 
 
-@app.task()
+@app.task(base=TimedTask)
 def update_datacatalog(args):
     """
     Adds ingested status into Data Catalog
@@ -426,8 +682,8 @@ def update_datacatalog(args):
     """
     ingested_items = args.get("success")
     if ingested_items:
-        for bagname, url in ingested_items.items():
-            update_ingest_status(bagname, url, application='dspace', project=None, ingested=True)
+        status = update_ingest_statuses(ingested_items, application='dspace', project=None, ingested=True)
+        logging.info("Data catalog update: {0}".format(status))
         return "Updated data catalog"
     return "No items to update in data catalog"
 
@@ -458,6 +714,72 @@ def remove_etd_catalog_record(id):
         return {"error": "Record {0} not found"}
 
 
+@app.task()
+def backfill_digital_object_mmsids(batch_size=1000):
+    """
+    Sets the indexed mmsid field on data catalog records of shareok bags that do not have one
+    Catalog records are created outside dspaceq without the field, so this is queued once when a
+    worker starts and celery beat runs it every CATALOG_BACKFILL_INTERVAL seconds
+
+    args:
+      batch_size (int); number of records to update in each bulk write
+    """
+    ensure_catalog_indexes()
+    digital_objects = app.backend.database.client.catalog.digital_objects
+    documents = digital_objects.find({'bag': {'$regex': '^share'}, 'mmsid': {'$exists': False}}, {'bag': 1})
+    updated = 0
+    updates = []
+    for document in documents:
+        mmsid = get_mmsid(document['bag'].split('/')[-1])
+        updates.append(UpdateOne({'_id': document['_id']}, {'$set': {'mmsid': mmsid}}))
+        if len(updates) >= batch_size:
+            updated += digital_objects.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        updated += digital_objects.bulk_write(updates, ordered=False).modified_count
+    return "Updated mmsid for {0} records".format(updated)
+
+
+if CATALOG_BACKFILL_INTERVAL:
+    _schedule("backfill-digital-object-mmsids", "dspaceq.tasks.tasks.backfill_digital_object_mmsids",
+              CATALOG_BACKFILL_INTERVAL)
+
+
+@worker_ready.connect
+def backfill_on_worker_ready(sender=None, **kwargs):
+    """ queues one mmsid backfill when a worker starts so get_digitized_bags does not depend on celery beat """
+    backfill_digital_object_mmsids.apply_async(queue=QUEUE_NAME)
+
+
+@app.task()
+def alma_cache_stats():
+    """
+    Returns the Alma bib record cache hit/miss counters for the worker process running this task
+    Each hit is an Alma API call that was not made
+    """
+    return bib_cache.stats()
+
+
+@app.task()
+def stage_timings():
+    """
+    Returns the time, calls and bytes of each ingest stage in the worker process running this task
+    Stages: alma_get, alma_put, alma_update, s3_list, s3_read, s3_download, xsd_compile, xsd_validate, xslt_compile, xslt,
+            prepare, dspace_import, mongo
+    """
+    return get_stage_totals()
+
+
+@app.task()
+def staging_cache_stats():
+    """
+    Returns the s3 staging cache hit/miss counters and bytes saved for the worker process running this task
+    """
+    if staging_cache is None:
+        return "S3 staging cache is not enabled"
+    return staging_cache.stats()
+
+
 @app.task()
 def list_missing_metadata_etd(bag=""):
     """
@@ -469,7 +791,7 @@ def list_missing_metadata_etd(bag=""):
 
     if bag == "":
         # Ingest requested items (bags) not yet ingested
-        bags = get_digitized_bags([etd['mmsid'] for etd in get_requested_etds(".*")])
+        bags = get_digitized_bags(get_requested_mmsids())
     else:
         bags = [bag]
 
@@ -489,7 +811,7 @@ def verify_good_bags(bag="", collection="",): #dspace_endpoint=REST_ENDPOINT):
 
     if bag == "":
         # Ingest requested items (bags) not yet ingested
-        bags = get_digitized_bags([etd['mmsid'] for etd in get_requested_etds(".*")])
+        bags = get_digitized_bags(get_requested_mmsids())
     else:
         bags = [bag]
 
@@ -500,8 +822,9 @@ def verify_good_bags(bag="", collection="",): #dspace_endpoint=REST_ENDPOINT):
     # initialize failed with bags with missing metadata
     failed = {}
     good_bags = []
+    bib_records = get_bib_records([get_mmsid(bag) for bag in bags])
     for bag in bags:
-        if check_missing(get_mmsid(bag))[0][1] != []:
+        if check_missing(get_mmsid(bag), bib_records)[0][1] != []:
             failed[bag] = "Missing required metadata in Alma - contact cataloging group"
         else:
             good_bags.append(bag)
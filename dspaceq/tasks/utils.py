@@ -1,19 +1,36 @@
 from __future__ import unicode_literals
 import boto3
+import codecs
+import grp
+import hashlib
+import multiprocessing
 import os
+import shutil
 import pkg_resources
 import re
 import requests
 import logging
 import datetime
+import random
+import threading
+import time
+from boto3.exceptions import RetriesExceededError
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from celery import Celery
-from bson.objectid import ObjectId
+from celery.concurrency import get_implementation
+from celery.signals import worker_init, worker_process_init
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 from itertools import compress
 from json import loads
+from tempfile import gettempdir
 from lxml import etree
 from collections import OrderedDict
 
-from .config import alma_url
+from .config import alma_url, alma_bibs_url
+from .instrument import span, timed, bound_to_bag, get_stage_totals
 
 logging.basicConfig(level=logging.INFO)
 
@@ -29,6 +46,42 @@ except ImportError:
     logging.error("Failed to import variables from celeryconfig")
     ALMA_KEY = ALMA_RW_KEY = ETD_NOTIFICATION_EMAIL = ALMA_NOTIFICATION_EMAIL = REST_ENDPOINT = ""
 
+# S3 download tuning - optional celeryconfig settings
+S3_DOWNLOAD_WORKERS = getattr(celeryconfig, "S3_DOWNLOAD_WORKERS", 8)  # concurrent files across all bags
+S3_DOWNLOAD_WORKERS_PER_BAG = getattr(celeryconfig, "S3_DOWNLOAD_WORKERS_PER_BAG", 4)  # concurrent files within a bag
+S3_DOWNLOAD_RETRIES = getattr(celeryconfig, "S3_DOWNLOAD_RETRIES", 3)
+S3_RETRY_STATUS = (408, 429)  # 4xx responses worth retrying - other client errors fail at once
+S3_MULTIPART_THRESHOLD = getattr(celeryconfig, "S3_MULTIPART_THRESHOLD", 64 * 1024 * 1024)  # bytes
+S3_MULTIPART_CHUNKSIZE = getattr(celeryconfig, "S3_MULTIPART_CHUNKSIZE", 16 * 1024 * 1024)  # bytes per range GET
+S3_MULTIPART_CONCURRENCY = getattr(celeryconfig, "S3_MULTIPART_CONCURRENCY", 4)  # range GETs per large file
+S3_LIST_WORKERS = getattr(celeryconfig, "S3_LIST_WORKERS", 8)  # concurrent bag listings
+S3_TEXT_WORKERS = getattr(celeryconfig, "S3_TEXT_WORKERS", 4)  # concurrent small text file reads
+S3_TEXT_MAX_BYTES = getattr(celeryconfig, "S3_TEXT_MAX_BYTES", 1024 * 1024)  # largest text file read into memory
+S3_TEXT_CHUNKSIZE = 64 * 1024  # bytes decoded at a time
+S3_STAGING_DIR = getattr(celeryconfig, "S3_STAGING_DIR", None)  # local cache of downloaded bag files - None disables
+S3_STAGING_MAX_BYTES = getattr(celeryconfig, "S3_STAGING_MAX_BYTES", 50 * 1024 ** 3)
+S3_STAGING_PART_MAX_AGE = getattr(celeryconfig, "S3_STAGING_PART_MAX_AGE", 24 * 3600)  # seconds before an unfinished download is removed
+
+# ownership of the ingest tree read by dspace import
+DSPACE_GROUP = getattr(celeryconfig, "DSPACE_GROUP", "tomcat")  # group the dspace import runs as
+DSPACE_DIR_MODE = 0o2775  # setgid so the ingest tree inherits DSPACE_GROUP
+DSPACE_FILE_MODE = 0o664
+
+# Alma API settings
+ALMA_BIBS_LIMIT = 100  # maximum number of mms_ids accepted by a single Alma /bibs request
+ALMA_POOL_SIZE = getattr(celeryconfig, "ALMA_POOL_SIZE", 10)  # keep-alive connections to Alma
+ALMA_WORKERS = getattr(celeryconfig, "ALMA_WORKERS", 4)  # concurrent Alma /bibs requests
+ALMA_CACHE_SIZE = getattr(celeryconfig, "ALMA_CACHE_SIZE", 1000)  # bib records held in worker memory
+ALMA_CACHE_TTL = getattr(celeryconfig, "ALMA_CACHE_TTL", 900)  # seconds - 0 disables the bib record cache
+ALMA_CACHE_BACKEND = getattr(celeryconfig, "ALMA_CACHE_BACKEND", None)  # None, "mongo" or "disk"
+# requests per second from a worker - split evenly between the processes of a prefork pool
+ALMA_RATE_LIMIT = getattr(celeryconfig, "ALMA_RATE_LIMIT", 20)
+# requests per day from all workers - counted in catalog.alma_api_usage of the celery result backend
+ALMA_DAILY_LIMIT = getattr(celeryconfig, "ALMA_DAILY_LIMIT", None)
+ALMA_RETRIES = getattr(celeryconfig, "ALMA_RETRIES", 3)  # retries of 429/5xx responses and connection errors
+ALMA_RETRY_STATUS = (429, 500, 502, 503, 504)
+ALMA_CACHE_DIR = getattr(celeryconfig, "ALMA_CACHE_DIR", os.path.join(gettempdir(), "dspaceq_alma_cache"))
+
 app = Celery()
 app.config_from_object(celeryconfig)
 
@@ -37,6 +90,380 @@ class FailedIngest(Exception):
     pass
 
 
+class AlmaQuotaExceeded(Exception):
+    """ Exception raised when the daily Alma API quota has been used """
+    pass
+
+
+class S3ObjectTooLarge(Exception):
+    """ Exception raised when an s3 object is too large to read into memory """
+    pass
+
+
+class TokenBucket(object):
+    """ thread safe token bucket limiting the rate of Alma API calls
+
+        rate (float); tokens added per second
+        capacity (int); largest burst of calls - defaults to rate, and at least one call
+        daily_limit (int); calls allowed per day - None for no limit
+        daily_counter (function); optional - records a call and returns the day's count shared with other
+                                  processes, otherwise calls are counted in this process only
+    """
+    def __init__(self, rate, capacity=None, daily_limit=None, daily_counter=None):
+        self.rate = rate
+        self.default_capacity = not capacity
+        self.capacity = capacity or max(rate, 1)
+        self.daily_limit = daily_limit
+        self.daily_counter = daily_counter
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.day = datetime.date.today()
+        self.daily_count = 0
+        self.exhausted = False  # daily limit reached by this or another process
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate):
+        """ changes the tokens added per second, and a default capacity with it """
+        with self._lock:
+            self.rate = rate
+            if self.default_capacity:
+                self.capacity = max(rate, 1)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def acquire(self):
+        """ blocks until a call may be made - raises AlmaQuotaExceeded when the daily limit is reached """
+        while True:
+            with self._lock:
+                if datetime.date.today() != self.day:
+                    self.day = datetime.date.today()
+                    self.daily_count = 0
+                    self.exhausted = False
+                if self.daily_limit is not None and self.daily_counter is None and self.daily_count >= self.daily_limit:
+                    self.exhausted = True
+                if self.exhausted:
+                    raise AlmaQuotaExceeded("Alma daily API limit reached")
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.daily_count += 1
+                    break
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+        if self.daily_limit is not None and self.daily_counter is not None and self.daily_counter() > self.daily_limit:
+            with self._lock:
+                self.exhausted = True
+            raise AlmaQuotaExceeded("Alma daily API limit reached")
+
+
+class BibRecordCache(object):
+    """ LRU cache of Alma bib records keyed by mmsid with a time to live
+
+        Records are kept in process memory and optionally shared between workers through a backend:
+          "mongo" - catalog.alma_bib_cache collection in the celery result backend
+          "disk" - one file per mmsid in directory
+        Only successfully fetched records should be stored.
+    """
+    def __init__(self, maxsize, ttl, backend=None, directory=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backend = backend
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._records = OrderedDict()  # {mmsid: (expires, bib_record)} - least recently used first
+        self._lock = threading.Lock()
+        self._mongo_indexed = False
+
+    def _mongo_collection(self):
+        collection = app.backend.database.client.catalog.alma_bib_cache
+        if not self._mongo_indexed:
+            collection.create_index("expires", expireAfterSeconds=0)
+            self._mongo_indexed = True
+        return collection
+
+    def _disk_path(self, mmsid):
+        return os.path.join(self.directory, "{0}.xml".format(mmsid))
+
+    def _backend_get_many(self, mmsids, now):
+        """ returns {mmsid: (expires, bib_record)} for the mmsids found in the shared backend """
+        entries = {}
+        try:
+            if self.backend == "mongo":
+                documents = self._mongo_collection().find(
+                    {"_id": {"$in": list(mmsids)}, "expires": {"$gt": datetime.datetime.utcfromtimestamp(now)}})
+                for document in documents:
+                    expires = (document["expires"] - datetime.datetime(1970, 1, 1)).total_seconds()
+                    entries[document["_id"]] = (expires, document["bib_record"])
+            elif self.backend == "disk":
+                for mmsid in mmsids:
+                    path = self._disk_path(mmsid)
+                    if os.path.isfile(path) and os.path.getmtime(path) + self.ttl > now:
+                        with open(path, "rb") as f:
+                            entries[mmsid] = (os.path.getmtime(path) + self.ttl, f.read())
+        except Exception as e:
+            logging.error("Could not read Alma cache backend: {0}".format(e))
+        return entries
+
+    def _backend_set(self, mmsid, bib_record, expires):
+        try:
+            if self.backend == "mongo":
+                self._mongo_collection().replace_one(
+                    {"_id": mmsid},
+                    {"_id": mmsid, "bib_record": bib_record, "expires": datetime.datetime.utcfromtimestamp(expires)},
+                    upsert=True)
+            elif self.backend == "disk":
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                path = self._disk_path(mmsid)
+                with open(path + ".tmp", "wb") as f:
+                    f.write(bib_record)
+                os.rename(path + ".tmp", path)
+        except Exception as e:
+            logging.error("Could not write Alma cache backend: {0}".format(e))
+
+    def _backend_delete(self, mmsid):
+        try:
+            if self.backend == "mongo":
+                self._mongo_collection().delete_one({"_id": mmsid})
+            elif self.backend == "disk" and os.path.isfile(self._disk_path(mmsid)):
+                os.remove(self._disk_path(mmsid))
+        except Exception as e:
+            logging.error("Could not remove {0} from Alma cache backend: {1}".format(mmsid, e))
+
+    def _store(self, mmsid, expires, bib_record):
+        """ store in memory, evicting the least recently used records - caller must hold the lock """
+        self._records.pop(mmsid, None)
+        self._records[mmsid] = (expires, bib_record)
+        while len(self._records) > self.maxsize:
+            self._records.popitem(last=False)
+
+    def get(self, mmsid):
+        """ returns the cached bib record or None """
+        return self.get_many([mmsid]).get(mmsid)
+
+    def get_many(self, mmsids):
+        """ returns {mmsid: bib record} for the cached mmsids
+
+            Records not held in memory are looked up in the shared backend with a single query
+        """
+        if not self.ttl:
+            return {}
+        now = time.time()
+        found = {}
+        missing = []
+        with self._lock:
+            for mmsid in mmsids:
+                entry = self._records.pop(mmsid, None)
+                if entry is not None and entry[0] > now:
+                    self._records[mmsid] = entry  # mark as most recently used
+                    found[mmsid] = entry[1]
+                else:
+                    missing.append(mmsid)
+            self.hits += len(found)
+        entries = self._backend_get_many(missing, now) if missing and self.backend else {}
+        with self._lock:
+            for mmsid in missing:
+                if mmsid in entries:
+                    self._store(mmsid, *entries[mmsid])
+                    found[mmsid] = entries[mmsid][1]
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        return found
+
+    def set(self, mmsid, bib_record):
+        if not self.ttl:
+            return
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._store(mmsid, expires, bib_record)
+        self._backend_set(mmsid, bib_record, expires)
+
+    def invalidate(self, mmsid):
+        """ remove a record that has changed in Alma """
+        with self._lock:
+            self._records.pop(mmsid, None)
+        self._backend_delete(mmsid)
+
+    def clear(self):
+        """ empty the in memory cache and reset counters """
+        with self._lock:
+            self._records.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """ returns hit/miss counters - each hit is an Alma API call saved """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._records),
+                    "maxsize": self.maxsize, "ttl": self.ttl, "backend": self.backend}
+
+
+def dspace_gid():
+    """ returns the gid of DSPACE_GROUP, or -1 to leave the group unchanged if it does not exist """
+    try:
+        return grp.getgrnam(DSPACE_GROUP).gr_gid
+    except KeyError:
+        logging.warning("Group {0} not found - ingest files keep the worker's group".format(DSPACE_GROUP))
+        return -1
+
+
+def share_dir(path, gid=None):
+    """ gives DSPACE_GROUP write access to a directory
+
+        The setgid bit makes files and directories created within it inherit the group,
+        so the tree never has to be walked to change ownership before the import
+    """
+    if gid is not None:
+        os.chown(path, -1, gid)
+    os.chmod(path, DSPACE_DIR_MODE)
+
+
+class StagingCache(object):
+    """ size bounded LRU cache of downloaded s3 objects on local disk
+
+        Files are named by a hash of the bucket, key and ETag, so a changed object is downloaded again.
+        Cached files are hardlinked into the ingest tree (copied if the cache is on another filesystem),
+        so a failed ingest can be retried without downloading its files again.
+        A hardlink shares the cached file's group and mode, so the cache directory is setgid DSPACE_GROUP
+        and files are cached with DSPACE_FILE_MODE, as in the ingest tree.
+        The least recently used files are removed once the cache exceeds max_bytes, and unfinished
+        downloads left by crashed workers once they are older than part_max_age seconds.
+    """
+    def __init__(self, directory, max_bytes, part_max_age=S3_STAGING_PART_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.part_max_age = part_max_age
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_downloaded = 0
+        self._lock = threading.Lock()
+
+    def _path(self, bucket, key, etag):
+        digest = hashlib.sha256("{0}/{1}:{2}".format(bucket, key, etag).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest)
+
+    @staticmethod
+    def _link(path, filename):
+        try:
+            os.link(path, filename)
+        except OSError:
+            shutil.copyfile(path, filename)
+
+    def fetch(self, s3_client, bucket, key, filename, config=None):
+        """ places the s3 object at filename, downloading it only if this version is not cached """
+        etag = s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+        path = self._path(bucket, key, etag)
+        try:
+            os.utime(path, None)  # mark as most recently used
+            self._link(path, filename)
+        except OSError:
+            pass  # not cached, or just evicted by another worker - download it
+        else:
+            with self._lock:
+                self.hits += 1
+                self.bytes_saved += os.path.getsize(filename)
+            return filename
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+            share_dir(self.directory, dspace_gid())
+        partial = "{0}.{1}.{2}.part".format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            kwargs = {"Config": config} if config else {}
+            s3_client.download_file(bucket, key, partial, **kwargs)
+            os.chmod(partial, DSPACE_FILE_MODE)
+            if s3_client.head_object(Bucket=bucket, Key=key)['ETag'] != etag:
+                # replaced while downloading - use the file but do not cache it under the old ETag
+                shutil.move(partial, filename)
+                return filename
+            self._link(partial, filename)  # before caching it, where another worker may evict it
+            os.rename(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        with self._lock:
+            self.misses += 1
+            self.bytes_downloaded += os.path.getsize(filename)
+        self.evict()
+        return filename
+
+    def evict(self):
+        """ removes stale unfinished downloads and the least recently used files until the cache fits in max_bytes """
+        entries = []
+        stale = time.time() - self.part_max_age
+        for name in os.listdir(self.directory):
+            try:
+                info = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue  # removed by another worker
+            if ".part" in name:  # our .part file or the temporary file boto3 downloads it through
+                if info.st_mtime < stale:
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+                continue
+            entries.append((info.st_mtime, info.st_size, name))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """ removes the cached files and resets counters """
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        with self._lock:
+            self.hits = self.misses = self.bytes_saved = self.bytes_downloaded = 0
+
+    def stats(self):
+        """ returns hit/miss counters and the bytes not downloaded from s3 because of cache hits """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved,
+                    "bytes_downloaded": self.bytes_downloaded, "max_bytes": self.max_bytes,
+                    "directory": self.directory}
+
+
+bib_cache = BibRecordCache(ALMA_CACHE_SIZE, ALMA_CACHE_TTL, ALMA_CACHE_BACKEND, ALMA_CACHE_DIR)
+staging_cache = StagingCache(S3_STAGING_DIR, S3_STAGING_MAX_BYTES) if S3_STAGING_DIR else None
+
+
+def count_alma_request():
+    """ records an Alma API call and returns the number made today by all workers """
+    usage = app.backend.database.client.catalog.alma_api_usage
+    document = usage.find_one_and_update({"_id": datetime.date.today().isoformat()}, {"$inc": {"count": 1}},
+                                         upsert=True, return_document=ReturnDocument.AFTER)
+    return document["count"]
+
+
+def worker_processes(pool=None, concurrency=None):
+    """ returns the number of processes sharing a worker's Alma rate limit
+
+        pool and concurrency default to the celery config, which does not include worker command line options
+    """
+    pool = get_implementation(pool or app.conf.get("worker_pool") or "prefork")
+    if pool.__module__ != "celery.concurrency.prefork":
+        return 1  # thread and green pools run every task in one process
+    return concurrency or app.conf.get("worker_concurrency") or multiprocessing.cpu_count()
+
+
+alma_rate_limiter = TokenBucket(float(ALMA_RATE_LIMIT) / worker_processes(), daily_limit=ALMA_DAILY_LIMIT,
+                                daily_counter=count_alma_request)
+
+
+@worker_init.connect
+def share_alma_rate_limit(sender=None, **kwargs):
+    """ divides ALMA_RATE_LIMIT between the pool processes the worker starts, before they fork """
+    alma_rate_limiter.set_rate(float(ALMA_RATE_LIMIT) / worker_processes(sender.pool_cls, sender.concurrency))
+
+
 def get_mmsid(bag):
     """ get the mmsid from end of bag name """
     # The MMS ID can be 8 to 19 digits long (with the first two digits referring to the record type and
@@ -60,24 +487,75 @@ def get_bags(url):
             break
 
 
+@timed("mongo")
 def get_requested_mmsids():
     """ queries requests for digitizations and returns list of mmsids """
     #return [bag['mmsid'] for bag in get_bags("https://cc.lib.ou.edu/api/catalog/data/catalog/etd/.json")]
     db_client = app.backend.database.client
     etd = db_client.catalog.etd
-    return [bag['mmsid'] for bag in etd.find({})]
+    return [bag['mmsid'] for bag in etd.find({}, {'mmsid': 1, '_id': 0})]
+
 
+@timed("mongo")
+def get_requested_etds(mmsids):
+    """ queries requests for digitization by mmsid and returns matching records
 
-def get_requested_etds(mmsid):
-    """ queries requests for digitization by mmsid regex and returns matching records """
+        args:
+          mmsids (list); mmsids to match exactly using the mmsid index
+                 (string); regular expression to match - this cannot use the index
+    """
     db_client = app.backend.database.client
     etd = db_client.catalog.etd
-    return [requested_item for requested_item in etd.find({'mmsid': {'$regex': mmsid}})]
+    if type(mmsids) == list:
+        query = {'mmsid': {'$in': mmsids}}
+    else:
+        query = {'mmsid': {'$regex': mmsids}}
+    return [requested_item for requested_item in etd.find(query)]
+
+
+def _create_alma_session():
+    """ returns a requests session with a pool of keep-alive connections to Alma """
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=ALMA_POOL_SIZE))
+    return session
+
+
+alma_session = _create_alma_session()
+
+
+@worker_process_init.connect
+def reset_alma_session(**kwargs):
+    """ drop pooled connections inherited from the parent so each worker process opens its own """
+    alma_session.close()
+
+
+def alma_request(method, url, **kwargs):
+    """ makes a rate limited request to Alma through the pooled session
+
+        429 and 5xx responses and connection errors are retried ALMA_RETRIES times with
+        jittered exponential backoff. Returns the last response or raises the last connection error.
+    """
+    for attempt in range(ALMA_RETRIES + 1):
+        alma_rate_limiter.acquire()
+        try:
+            with span("alma_{0}".format(method.lower())) as measurement:
+                response = alma_session.request(method, url, **kwargs)
+                if isinstance(response.content, bytes):
+                    measurement["bytes"] = len(response.content)
+        except requests.exceptions.RequestException as e:
+            if attempt == ALMA_RETRIES:
+                raise
+            logging.warning("Alma connection error - retrying: {0}".format(e))
+        else:
+            if response.status_code not in ALMA_RETRY_STATUS or attempt == ALMA_RETRIES:
+                return response
+            logging.warning("Alma server returned code: {0} - retrying".format(response.status_code))
+        time.sleep(random.uniform(0, 2 ** attempt))
 
 
 def get_bib_record(mmsid):
     try:
-        result = requests.get(alma_url.format(mmsid, ALMA_KEY))
+        result = alma_request("GET", alma_url.format(mmsid, ALMA_KEY))
         if result.status_code == requests.codes.ok:
             return result.content
         else:
@@ -89,37 +567,342 @@ def get_bib_record(mmsid):
         return {"error": "Alma Connection Error - try again later."}
 
 
+def _get_bib_records_chunk(mmsids):
+    """ requests up to ALMA_BIBS_LIMIT bib records in one call and returns {mmsid: bib record} """
+    try:
+        result = alma_request("GET", alma_bibs_url.format(",".join(mmsids), ALMA_KEY))
+    except AlmaQuotaExceeded as e:
+        logging.error(e)
+        return {mmsid: {"error": "Alma daily API limit reached - try again tomorrow."} for mmsid in mmsids}
+    except Exception as e:
+        logging.error("Alma Connection Error")
+        logging.error(e)
+        return {mmsid: {"error": "Alma Connection Error - try again later."} for mmsid in mmsids}
+    if result.status_code != requests.codes.ok:
+        logging.error(result.content)
+        return {mmsid: {"error": "Alma server returned code: {0}".format(result.status_code)} for mmsid in mmsids}
+    bib_records = {bib.findtext("mms_id"): etree.tostring(bib, encoding="UTF-8", with_tail=False)
+                   for bib in etree.fromstring(result.content).iter("bib")}
+    return {mmsid: bib_records.get(mmsid, {"error": "Alma record not found: {0}".format(mmsid)}) for mmsid in mmsids}
+
+
+def get_bib_records(mmsids, cache=True):
+    """ returns {mmsid: bib record} fetching each distinct mmsid from Alma only once
+
+        Records are requested in batches using the multi mms_id form of the Alma /bibs API,
+        with up to ALMA_WORKERS batches in flight at once.
+        Failed lookups are returned as an error dictionary in the same way as get_bib_record.
+        A mmsid of None maps to None.
+
+        args:
+          mmsids [string]; mmsids to look up
+          cache (boolean); use and populate bib_cache - disable when the record is going to be modified
+    """
+    unique_mmsids = list(OrderedDict.fromkeys(mmsid for mmsid in mmsids if mmsid))
+    bib_records = {mmsid: None for mmsid in mmsids if not mmsid}
+    if cache:
+        bib_records.update(bib_cache.get_many(unique_mmsids))
+        unique_mmsids = [mmsid for mmsid in unique_mmsids if mmsid not in bib_records]
+    chunks = list(chunk_list(unique_mmsids, ALMA_BIBS_LIMIT))
+    if len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=ALMA_WORKERS) as executor:
+            fetched_chunks = list(executor.map(bound_to_bag(_get_bib_records_chunk), chunks))
+    else:
+        fetched_chunks = [_get_bib_records_chunk(chunk) for chunk in chunks]
+    for fetched in fetched_chunks:
+        if cache:
+            for mmsid, bib_record in fetched.items():
+                if type(bib_record) is not dict:
+                    bib_cache.set(mmsid, bib_record)
+        bib_records.update(fetched)
+    return bib_records
+
+
+MARC_NS = "http://www.loc.gov/MARC21/slim"
+
+
 def get_marc_from_bib(bib_record):
     """ returns marc xml from bib record string"""
     record = etree.fromstring(bib_record).find("record")
-    record.attrib['xmlns'] = "http://www.loc.gov/MARC21/slim"
+    record.attrib['xmlns'] = MARC_NS
     return etree.ElementTree(record)
 
 
+# Compiled XSLT / XSD package resources shared by every task in the worker process
+MARC2DC_XSLT = 'xslt/marc2dspacedc.xsl'
+MARC21_XSD = 'xslt/MARC21slim.xsd'
+XML_RESOURCES = {MARC2DC_XSLT: etree.XSLT, MARC21_XSD: etree.XMLSchema}
+
+# instrument stages timing each resource - {resource name: (compile stage, apply stage)}
+XML_STAGES = {MARC2DC_XSLT: ("xslt_compile", "xslt"), MARC21_XSD: ("xsd_compile", "xsd_validate")}
+
+_xml_resources = {}  # {resource name: (mtime, compiled resource)}
+_xml_resources_lock = threading.Lock()
+
+
+def get_xml_timings():
+    """ returns compile vs apply counts and total seconds for each xml resource from the stage totals """
+    totals = get_stage_totals()
+    empty = {"count": 0, "seconds": 0.0}
+    timings = {}
+    for name, (compile_stage, apply_stage) in XML_STAGES.items():
+        if compile_stage in totals or apply_stage in totals:
+            timings[name] = {stage: {key: totals.get(stage_name, empty)[key] for key in empty}
+                             for stage, stage_name in (("compile", compile_stage), ("apply", apply_stage))}
+    return timings
+
+
+def get_xml_resource(name):
+    """ returns the compiled XSLT or XMLSchema for a package resource
+
+        The resource is compiled once per process and recompiled if the file has been modified
+    """
+    path = pkg_resources.resource_filename(__name__, name)
+    mtime = os.path.getmtime(path)
+    with _xml_resources_lock:
+        cached = _xml_resources.get(name)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with span(XML_STAGES[name][0]):
+        compiled = XML_RESOURCES[name](etree.parse(path))
+    logging.info("Compiled {0}".format(name))
+    with _xml_resources_lock:
+        _xml_resources[name] = (mtime, compiled)
+    return compiled
+
+
+def reload_xml_resources():
+    """ discards compiled xml resources and compiles them again """
+    with _xml_resources_lock:
+        _xml_resources.clear()
+    for name in XML_RESOURCES:
+        get_xml_resource(name)
+
+
+@worker_process_init.connect
+def warm_xml_resources(**kwargs):
+    """ compile xml resources when a celery worker process starts """
+    reload_xml_resources()
+
+
 def marc_xml_to_dc_xml(marc_xml):
     """ returns dublin core xml from marc xml """
-    xml_path = pkg_resources.resource_filename(__name__, 'xslt/marc2dspacedc.xsl')
-    marc2dc_xslt = etree.parse(xml_path)
-    transform = etree.XSLT(marc2dc_xslt)
-    return transform(marc_xml)
+    transform = get_xml_resource(MARC2DC_XSLT)
+    with span(XML_STAGES[MARC2DC_XSLT][1]):
+        return transform(marc_xml)
+
+def _namespace_marc(root):
+    """ returns root with its elements moved into the MARC namespace
+
+        get_marc_from_bib only adds an xmlns attribute, so the elements are moved under a new
+        namespaced root rather than serializing and parsing the record again
+    """
+    if root.tag.startswith("{"):
+        return root
+    prefix = "{{{0}}}".format(MARC_NS)
+    attrib = {key: value for key, value in root.attrib.items() if key != 'xmlns'}
+    namespaced = etree.Element(prefix + root.tag, attrib=attrib, nsmap={None: MARC_NS})
+    namespaced.text = root.text
+    namespaced.extend(list(root))
+    for element in namespaced.iterdescendants(tag=etree.Element):
+        if not element.tag.startswith("{"):
+            element.tag = prefix + element.tag
+    return namespaced
 
 def validate_marc(marc_xml):
-    xml = pkg_resources.resource_string(__name__, 'xslt/MARC21slim.xsd')
-    schema = etree.XMLSchema(etree.fromstring(xml))
-    parser = etree.XMLParser(schema=schema)
-    return etree.fromstring(etree.tostring(marc_xml), parser)
+    """ returns the namespaced marc xml element, raising DocumentInvalid if it fails the MARC21 schema
+
+        Child elements of marc_xml are moved into the returned element
+    """
+    root = marc_xml.getroot() if hasattr(marc_xml, 'getroot') else marc_xml
+    root = _namespace_marc(root)
+    schema = get_xml_resource(MARC21_XSD)
+    with span(XML_STAGES[MARC21_XSD][1]):
+        schema.assertValid(root)
+    return root
 
 def bib_to_dc(bib_record):
-    """ returns dc as string from bib_record """
+    """ returns dc as string from bib_record - the record is parsed once and validated in place """
     return etree.tostring(marc_xml_to_dc_xml(validate_marc(get_marc_from_bib(bib_record))))
 
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """ returns a boto3 s3 client shared by all threads of the worker process """
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client('s3')
+        return _s3_client
+
+
+@worker_process_init.connect
+def reset_s3_client(**kwargs):
+    """ create a new client in each worker process rather than using one inherited from the parent """
+    global _s3_client
+    with _s3_client_lock:
+        _s3_client = None
+
+
 def list_s3_files(bag_name):
+    """ returns the pdf and txt files in the data directory of a bag """
     s3_bucket=os.getenv('DEFAULT_BUCKET','ul-bagit')
     s3_destination='private/shareok/{0}/data/'.format(bag_name)
-    s3 = boto3.client('s3')
-    files = [x['Key'] for x in s3.list_objects(Bucket=s3_bucket, Prefix=s3_destination)['Contents']]
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    with span("s3_list", bag=bag_name):
+        files = [x['Key'] for page in paginator.paginate(Bucket=s3_bucket, Prefix=s3_destination)
+                 for x in page.get('Contents', [])]
     return [f for f in files if f.endswith((".pdf", ".txt"))]
 
+
+def list_s3_files_batch(bag_names, max_workers=None):
+    """ returns {bag_name: [files]} listing the bags concurrently """
+    if not bag_names:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers or S3_LIST_WORKERS) as executor:
+        return dict(zip(bag_names, executor.map(bound_to_bag(list_s3_files), bag_names)))
+
+def read_s3_text(key, bucket=None, max_bytes=None):
+    """ returns the utf-8 text of a small s3 object
+
+        The body is streamed and decoded in chunks, raising S3ObjectTooLarge as soon as
+        more than max_bytes would be read
+    """
+    bucket = bucket or os.getenv('DEFAULT_BUCKET','ul-bagit')
+    max_bytes = max_bytes or S3_TEXT_MAX_BYTES
+    with span("s3_read") as measurement:
+        response = get_s3_client().get_object(Bucket=bucket, Key=key)
+        body = response['Body']
+        try:
+            if response.get('ContentLength', 0) > max_bytes:
+                raise S3ObjectTooLarge(key)
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            text = []
+            for chunk in body.iter_chunks(S3_TEXT_CHUNKSIZE):
+                measurement["bytes"] += len(chunk)
+                if measurement["bytes"] > max_bytes:
+                    raise S3ObjectTooLarge(key)
+                text.append(decoder.decode(chunk))
+            text.append(decoder.decode(b"", final=True))
+        finally:
+            body.close()
+    return "".join(text)
+
+
+def read_s3_texts(keys, bucket=None, max_bytes=None, max_workers=None):
+    """ returns {key: text} reading the s3 objects concurrently """
+    if not keys:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers or S3_TEXT_WORKERS) as executor:
+        return dict(zip(keys, executor.map(bound_to_bag(lambda key: read_s3_text(key, bucket, max_bytes)), keys)))
+
+
+def _is_permanent_s3_error(error):
+    """ returns True for client errors such as a missing object or denied access that a retry cannot fix """
+    if not isinstance(error, ClientError):
+        return False
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    if status is None:
+        code = error.response.get('Error', {}).get('Code', '')
+        status = int(code) if code.isdigit() else None
+    return status is not None and 400 <= status < 500 and status not in S3_RETRY_STATUS
+
+
+def _download_s3_file(s3_client, bucket, key, filename, config, retries, bag=None):
+    """ downloads a single s3 object, retrying transient failures with backoff """
+    for attempt in range(retries + 1):
+        try:
+            with span("s3_download", bag=bag) as measurement:
+                if staging_cache is not None:
+                    staging_cache.fetch(s3_client, bucket, key, filename, config)
+                else:
+                    s3_client.download_file(bucket, key, filename, Config=config)
+                if os.path.isfile(filename):
+                    os.chmod(filename, DSPACE_FILE_MODE)  # readable by the import whatever the worker's umask
+                    measurement["bytes"] = os.path.getsize(filename)
+            return filename
+        except (BotoCoreError, ClientError, RetriesExceededError) as e:
+            if attempt == retries or _is_permanent_s3_error(e):
+                logging.error("Failed to download {0}: {1}".format(key, e))
+                raise
+            logging.warning("Retrying download of {0} after error: {1}".format(key, e))
+            time.sleep(2 ** attempt)
+
+
+def download_s3_bags(s3_client, bucket, bags, max_workers=None, per_bag=None, retries=None, names=None, executor=None):
+    """ downloads the files of many bags concurrently
+
+        Files are saved into their bag directory using the last part of the key.
+        Objects larger than S3_MULTIPART_THRESHOLD are fetched with parallel range GETs.
+        When S3_STAGING_DIR is set, files already in the staging cache are linked instead of downloaded.
+        Yields each bag directory once all of its files have been downloaded.
+
+        args:
+          s3_client; boto3 s3 client (clients are safe to share between threads)
+          bucket (string); s3 bucket name
+          bags (dict); {bag_dir: [s3 keys]}
+          max_workers (int); concurrent downloads across all bags
+          per_bag (int); concurrent downloads within a single bag
+          retries (int); attempts to make after a failed download
+          names (dict); optional {bag_dir: bag name} to record download timings against
+          executor (ThreadPoolExecutor); optional - download on a pool shared with other callers,
+                                         so concurrent callers stay within its max_workers.
+                                         When a download fails, the other queued downloads are cancelled and
+                                         those already running finish before the error is raised
+    """
+    max_workers = max_workers or S3_DOWNLOAD_WORKERS
+    per_bag = per_bag or S3_DOWNLOAD_WORKERS_PER_BAG
+    retries = S3_DOWNLOAD_RETRIES if retries is None else retries
+    config = TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD,
+                            multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                            max_concurrency=S3_MULTIPART_CONCURRENCY)
+    pending = {bag_dir: list(keys) for bag_dir, keys in bags.items()}
+    remaining = {bag_dir: len(keys) for bag_dir, keys in pending.items()}
+    for bag_dir in bags:
+        if remaining[bag_dir] == 0:
+            yield bag_dir
+
+    owned = executor is None
+    if owned:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        running = {}
+
+        def submit(bag_dir):
+            key = pending[bag_dir].pop(0)
+            filename = os.path.join(bag_dir, key.split("/")[-1])
+            bag = (names or {}).get(bag_dir, os.path.basename(bag_dir))
+            future = executor.submit(bound_to_bag(_download_s3_file), s3_client, bucket, key, filename, config, retries, bag)
+            running[future] = bag_dir
+
+        for bag_dir in bags:
+            for _ in range(min(per_bag, len(pending[bag_dir]))):
+                submit(bag_dir)
+        while running:
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                bag_dir = running.pop(future)
+                future.result()  # raise the download error if retries were exhausted
+                remaining[bag_dir] -= 1
+                if pending[bag_dir]:
+                    submit(bag_dir)
+                elif remaining[bag_dir] == 0:
+                    yield bag_dir
+    finally:
+        # after a failure, stop the other downloads before the caller removes their directories
+        for future in running:
+            future.cancel()  # not started yet
+        if running:
+            wait(list(running))
+        for future, bag_dir in running.items():
+            if not future.cancelled() and future.exception() is not None:
+                logging.error("Download into {0} also failed: {1}".format(bag_dir, future.exception()))
+        if owned:
+            executor.shutdown()
+
+
 def missing_fields(bib_record):
     def missing_or_blank(xpath_val):
         """ check if xpath is missing or blank """
@@ -176,11 +959,17 @@ def guess_collection(bib_record):
     return collections["{0}_{1}".format(use_org, use_type)]
 
 
-def check_missing(mmsids):
-    """ Checks for missing fields stored in Alma """
+def check_missing(mmsids, bib_records=None):
+    """ Checks for missing fields stored in Alma
+
+        args:
+          mmsids (string or list); mmsid(s) to check
+          bib_records (dict); optional {mmsid: bib record} previously returned by get_bib_records
+    """
     mmsids = [mmsids] if type(mmsids) != list else mmsids
-    bib_records = map(get_bib_record, mmsids)
-    missing = map(missing_fields, bib_records)
+    if bib_records is None:
+        bib_records = get_bib_records(mmsids)
+    missing = [missing_fields(bib_records.get(mmsid)) for mmsid in mmsids]
     return list(zip(mmsids, missing))
 
 
@@ -199,50 +988,101 @@ def chunk_list(_list, size):
         yield _list[x:x + size]
 
 
+def ensure_catalog_indexes():
+    """ creates the data catalog indexes used by dspaceq queries """
+    catalog = app.backend.database.client.catalog
+    catalog.digital_objects.create_index([('mmsid', ASCENDING)])
+    catalog.digital_objects.create_index([('bag', ASCENDING)])
+    catalog.etd.create_index([('mmsid', ASCENDING)])
+
+
+@timed("mongo")
 def get_digitized_bags(mmsids):
     """ queries list of mmsids and yields iterator of bagnames
 
         This looks for digitized objects in S3 that have not been ingested into shareok
 
+        Uses the indexed mmsid field of the digital object - records created since the last
+        backfill_digital_object_mmsids run are matched on a bag name ending in the mmsid
     """
     if type(mmsids) != list:
         mmsids = [mmsids]
-    regex_list = '|'.join('^share.*{0}$'.format(mmsid) for mmsid in mmsids)
-    options = {'bag':{'$regex': regex_list},
+    mmsids = [str(mmsid) for mmsid in mmsids]
+    if not mmsids:
+        return []
+    ends_with_mmsid = '^share.*(?:{0})$'.format('|'.join(re.escape(mmsid) for mmsid in mmsids))
+    options = {'$or': [{'mmsid': {'$in': mmsids}, 'bag': {'$regex': '^share'}},
+                       {'mmsid': {'$exists': False}, 'bag': {'$regex': ends_with_mmsid}}],
                'locations.s3.exists': True,
                'application.dspace.ingested': {'$ne': True},
               }
     db_client = app.backend.database.client
     digital_objects = db_client.catalog.digital_objects
-    results = digital_objects.find(options)
-    return [result['bag'].split('/')[-1] for result in results]
+    results = digital_objects.find(options, {'bag': 1, 'mmsid': 1})
+    requested = set(mmsids)
+    bags = []
+    for result in results:
+        bag = result['bag'].split('/')[-1]
+        mmsid = result.get('mmsid', get_mmsid(bag))
+        if mmsid in requested and bag.endswith(mmsid):  # not versioned copies such as <bag>_ver2
+            bags.append(bag)
+    return bags
 
-def update_ingest_status(bagname, url, application='dspace', project=None, ingested=True):
-    options = {'ingested': ingested,
-               'url': url,
-               'datetime': datetime.datetime.utcnow().isoformat()
-               }
+@timed("mongo")
+def update_ingest_statuses(items, application='dspace', project=None, ingested=True):
+    """ sets the ingest status of many bags with a single unordered bulk write
+
+        Only the application.<application> status fields (and the indexed mmsid) are updated,
+        other attributes of the data catalog record are left untouched
+
+        args:
+          items (dict); {bagname: url}
+        returns:
+          {"updated": [bagname, ...], "not_found": [bagname, ...], "failed": {bagname: error}}
+    """
+    status = {"updated": [], "not_found": [], "failed": {}}
+    if not items:
+        return status
+    timestamp = datetime.datetime.utcnow().isoformat()
     db_client = app.backend.database.client
     digital_objects = db_client.catalog.digital_objects
 
     # verify and update bagname to include shareok path in name
-    if not re.match("^shareok", bagname):
-        bagname = "shareok/{0}".format(bagname)
-
+    catalog_bags = OrderedDict(
+        (bagname if re.match("^shareok", bagname) else "shareok/{0}".format(bagname), bagname) for bagname in items)
+    query = {'bag': {'$in': list(catalog_bags)}}
     if project is not None:
-        document = digital_objects.find_one({'bag': bagname, 'project': project})
-    else:
-        document = digital_objects.find_one({'bag': bagname})
-
-    if document:
-        if not document.get('application'):
-            document['application'] = {}
-        if not document['application'].get(application):
-            document['application'][application] = {}
-        # iterate over options to preserve other existing attributes
-        for option, value in options.items():
-            document['application'][application][option] = value
-        if document != {}:  # prevent overwriting with blank document
-            status = digital_objects.update({'_id': ObjectId(document['_id'])}, document)
-            if not status['nModified']:
-                logging.error("Could not update dspace ingest status: {0}".format(document['bag']))
\ No newline at end of file
+        query['project'] = project
+    found = {document['bag'] for document in digital_objects.find(query, {'bag': 1})}
+
+    updates = []
+    for catalog_bag, bagname in catalog_bags.items():
+        if catalog_bag not in found:
+            logging.error("Could not update {0} ingest status: {1} not found".format(application, catalog_bag))
+            status["not_found"].append(bagname)
+            continue
+        document_query = {'bag': catalog_bag}
+        if project is not None:
+            document_query['project'] = project
+        updates.append((bagname, UpdateOne(document_query, {'$set': {
+            'application.{0}.ingested'.format(application): ingested,
+            'application.{0}.url'.format(application): items[bagname],
+            'application.{0}.datetime'.format(application): timestamp,
+            'mmsid': get_mmsid(catalog_bag.split('/')[-1])
+        }})))
+    if not updates:
+        return status
+
+    try:
+        digital_objects.bulk_write([update for bagname, update in updates], ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get('writeErrors', []):
+            bagname = updates[error['index']][0]
+            logging.error("Could not update {0} ingest status: {1}".format(application, bagname))
+            status["failed"][bagname] = error.get('errmsg')
+    status["updated"] = [bagname for bagname, update in updates if bagname not in status["failed"]]
+    return status
+
+
+def update_ingest_status(bagname, url, application='dspace', project=None, ingested=True):
+    update_ingest_statuses({bagname: url}, application=application, project=project, ingested=ingested)
@@ -4,7 +4,7 @@ from setuptools import setup, find_packages
 setup(name='dspaceq',      
       version='0.2.2',
       packages= find_packages(),
-      package_data={'dspaceq':['tasks/xslt/*']},
+      package_data={'dspaceq':['tasks/xslt/*', 'tasks/templates/*']},
       install_requires=[
           'celery==5.2.7 ; python_version >= "3.6"',
           'celery==3.1.22 ; python_version < "3.6"',
@@ -18,6 +18,7 @@ setup(name='dspaceq',
           'boto3',
           'lxml',
           'six',
+          'futures ; python_version < "3"',
       ],
       include_package_data=True,
 )
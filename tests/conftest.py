@@ -16,6 +16,8 @@ def aws_credentials():
 
 @pytest.fixture(scope="function")
 def s3_client(aws_credentials):
+    from dspaceq.tasks.utils import reset_s3_client
+    reset_s3_client()
     with mock_s3():
         yield boto3.client('s3', region_name='us-east-1')
         
@@ -53,6 +55,11 @@ def mock_get_requested_etds(mocker):
     yield mocker.patch('dspaceq.tasks.tasks.get_requested_etds')
     mocker.stopall()
     
+@pytest.fixture()
+def mock_get_requested_mmsids(mocker):
+    yield mocker.patch('dspaceq.tasks.tasks.get_requested_mmsids')
+    mocker.stopall()
+
 @pytest.fixture()
 def mock_boto3(mocker):
     yield mocker.patch('dspaceq.tasks.tasks.boto3')
@@ -64,8 +71,11 @@ def mock_mkdtemp(mocker):
     mocker.stopall()
     
 @pytest.fixture()
-def mock_check_call(mocker):
-    yield mocker.patch('dspaceq.tasks.tasks.check_call')
+def mock_popen(mocker):
+    mock_popen = mocker.patch('dspaceq.tasks.tasks.Popen')
+    mock_popen.return_value.poll.return_value = 0
+    mock_popen.return_value.returncode = 0
+    yield mock_popen
     mocker.stopall()
 @pytest.fixture()
 def mock_rmtree(mocker):
@@ -86,6 +96,11 @@ def mock_get_mmsid(mocker):
 def mock_list_s3_files(mocker):
     yield mocker.patch('dspaceq.tasks.tasks.list_s3_files')
     mocker.stopall()
+
+@pytest.fixture()
+def mock_list_s3_files_batch(mocker):
+    yield mocker.patch('dspaceq.tasks.tasks.list_s3_files_batch')
+    mocker.stopall()
     
 @pytest.fixture(scope='function')
 def mock_check_missing(mocker):
@@ -108,6 +123,11 @@ def mock_get_bib_record(mocker):
     yield mock_get_bib_record
     mocker.stopall()
 
+@pytest.fixture()
+def mock_get_bib_records(mocker):
+    yield mocker.patch('dspaceq.tasks.tasks.get_bib_records')
+    mocker.stopall()
+
 @pytest.fixture()
 def mock_guess_collection(mocker):
     yield mocker.patch('dspaceq.tasks.tasks.guess_collection')
@@ -122,18 +142,40 @@ def mock_celery_signature(mocker):
 def mock_celery_group(mocker):
     yield  mocker.patch('dspaceq.tasks.tasks.group')
     mocker.stopall()
+
+@pytest.fixture()
+def mock_celery_chord(mocker):
+    yield mocker.patch('dspaceq.tasks.tasks.chord')
+    mocker.stopall()
    
+@pytest.fixture()
+def mock_tasks_backend(mocker):
+    yield mocker.patch('dspaceq.tasks.tasks.Celery.backend')
+    mocker.stopall()
+
 @pytest.fixture(scope='function')
 def mock_get_digitized_bags(mocker):
     yield mocker.patch('dspaceq.tasks.tasks.get_digitized_bags')
     mocker.stopall()
     
 '__________________________________________fixture of utils____________________________________________'
+@pytest.fixture(autouse=True)
+def clear_bib_cache():
+    from dspaceq.tasks.utils import bib_cache
+    bib_cache.clear()
+    yield bib_cache
+    bib_cache.clear()
+
 @pytest.fixture()
 def mock_utils_get_bib_record(mocker):
     yield mocker.patch('dspaceq.tasks.utils.get_bib_record')
     mocker.stopall()
     
+@pytest.fixture()
+def mock_utils_get_bib_records(mocker):
+    yield mocker.patch('dspaceq.tasks.utils.get_bib_records')
+    mocker.stopall()
+
 @pytest.fixture()
 def mock_tasks_get_bib_record(mocker):
     yield mocker.patch('dspaceq.tasks.tasks.get_bib_record')
@@ -144,6 +186,12 @@ def mock_requests_get(mocker):
     yield mocker.patch('dspaceq.tasks.utils.requests.get')
     mocker.stopall()
     
+@pytest.fixture()
+def mock_alma_session(mocker):
+    mocker.patch('dspaceq.tasks.utils.ALMA_RETRIES', 0)
+    yield mocker.patch('dspaceq.tasks.utils.alma_session')
+    mocker.stopall()
+
 @pytest.fixture()
 def mock_celery_backend(mocker):
     yield mocker.patch('dspaceq.tasks.utils.Celery.backend')
@@ -152,5 +200,6 @@ def mock_celery_backend(mocker):
 
 @pytest.fixture()
 def mock_create_engine(mocker):
+    mocker.patch('dspaceq.tasks.reports._engine', None)
     yield mocker.patch('dspaceq.tasks.reports.create_engine')
     mocker.stopall()
\ No newline at end of file
@@ -0,0 +1,136 @@
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from celery import Celery
+from celery.utils.functional import head_from_fun
+
+from dspaceq.tasks import instrument
+from dspaceq.tasks.instrument import span, timed, bound_to_bag, collect_timings, TimedTask, get_stage_totals, \
+    reset_stage_totals
+
+app = Celery()
+
+
+@pytest.fixture(autouse=True)
+def clear_stage_totals():
+    reset_stage_totals()
+    yield
+    reset_stage_totals()
+
+
+def test_span_records_stages_per_bag():
+    @timed("xslt")
+    def transform():
+        return "dc"
+
+    with collect_timings() as timings:
+        with span("prepare", bag="Smith_2019_1"):
+            assert transform() == "dc"
+            with span("s3_read") as measurement:
+                measurement["bytes"] = 10
+        with span("s3_read", nbytes=5):
+            pass
+    summary = timings.summary()
+    assert summary["stages"]["s3_read"]["count"] == 2
+    assert summary["stages"]["s3_read"]["bytes"] == 15
+    assert sorted(summary["bags"]["Smith_2019_1"]) == ["prepare", "s3_read", "xslt"]
+    assert summary["bags"]["Smith_2019_1"]["s3_read"]["bytes"] == 10
+    assert get_stage_totals()["xslt"]["count"] == 1
+
+    # only recorded while collecting
+    with span("xslt"):
+        pass
+    assert timings.summary()["stages"]["xslt"]["count"] == 1
+    assert get_stage_totals()["xslt"]["count"] == 2
+
+def test_bound_to_bag_in_worker_threads():
+    with collect_timings() as timings:
+        with span("prepare", bag="Smith_2019_1"):
+            def read(key):
+                with span("s3_read"):
+                    return key
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                assert list(executor.map(bound_to_bag(read), ["a", "b"])) == ["a", "b"]
+    assert timings.summary()["bags"]["Smith_2019_1"]["s3_read"]["count"] == 2
+
+def test_collect_timings_per_task():
+    """ tasks running in other threads of the process (thread or green pools) are not collected """
+    started = [threading.Event(), threading.Event()]
+    recorded = [threading.Event(), threading.Event()]
+
+    def task(index, bag):
+        # both tasks are collecting while each records its span
+        with collect_timings() as timings:
+            started[index].set()
+            started[1 - index].wait(5)
+            with span("prepare", bag=bag):
+                pass
+            recorded[index].set()
+            recorded[1 - index].wait(5)
+        return timings.summary()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        summaries = list(executor.map(task, [0, 1], ["Smith_2019_1", "Jones_2019_2"]))
+    assert [list(summary["bags"]) for summary in summaries] == [["Smith_2019_1"], ["Jones_2019_2"]]
+    assert [summary["stages"]["prepare"]["count"] for summary in summaries] == [1, 1]
+    assert get_stage_totals()["prepare"]["count"] == 2
+
+def test_timed_task(mocker):
+    @app.task(base=TimedTask, name="timed_task")
+    def task(value):
+        with span("mongo"):
+            return {"value": value}
+
+    assert task(1) == {"value": 1}
+    mocker.patch('dspaceq.tasks.instrument.TASK_TIMINGS', True)
+    result = task(2)
+    assert result["value"] == 2
+    assert result["timings"]["stages"]["mongo"]["count"] == 1
+    assert result["timings"]["bags"] == {}
+
+def test_timed_task_keeps_signature():
+    @app.task(base=TimedTask, name="timed_task_signature")
+    def task(value):
+        return value
+
+    head_from_fun(task.run)(1)
+    with pytest.raises(TypeError):
+        head_from_fun(task.run)(bogus=1)
+
+def test_export_prometheus_textfile(tmpdir, mocker):
+    mocker.patch('dspaceq.tasks.instrument.STAGE_METRICS_DIR', str(tmpdir))
+
+    @app.task(base=TimedTask, name="timed_task_prometheus")
+    def task():
+        with span("s3_download", bag="Smith_2019_1", nbytes=2048):
+            pass
+        raise ValueError("failed ingest")
+
+    with pytest.raises(ValueError):
+        task()
+    metrics = (tmpdir / "dspaceq_{0}.prom".format(os.getpid())).read()
+    assert "# TYPE dspaceq_stage_seconds_total counter" in metrics
+    assert 'dspaceq_stage_calls_total{{stage="s3_download",pid="{0}"}} 1'.format(os.getpid()) in metrics
+    assert 'dspaceq_stage_bytes_total{{stage="s3_download",pid="{0}"}} 2048'.format(os.getpid()) in metrics
+
+def test_export_statsd(mocker):
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.settimeout(5)
+    mocker.patch('dspaceq.tasks.instrument.STAGE_METRICS_STATSD', "127.0.0.1:{0}".format(server.getsockname()[1]))
+
+    @app.task(base=TimedTask, name="timed_task_statsd")
+    def task():
+        instrument.record_stage("alma_get", 0.25, nbytes=100)
+
+    try:
+        task()
+        lines = server.recv(4096).decode("utf-8").split("\n")
+    finally:
+        server.close()
+    assert lines == ["dspaceq.stage.alma_get.seconds:250.000|ms",
+                     "dspaceq.stage.alma_get.calls:1|c",
+                     "dspaceq.stage.alma_get.bytes:100|c"]
@@ -1,3 +1,6 @@
+import io
+import json
+import os
 import sys
 
 try:
@@ -10,7 +13,7 @@ import sqlalchemy
 from requests.exceptions import HTTPError
 from sqlalchemy.dialects import postgresql
 
-from dspaceq.tasks.reports import report_embargoed_items, AUTHOR, URI, TITLE, ALTERNATIVE_TITLE, DEPARTMENT
+from dspaceq.tasks.reports import report_embargoed_items, startdate_query, startdate_collection_query, AUTHOR, URI, TITLE, ALTERNATIVE_TITLE, DEPARTMENT
 from datetime import datetime
 
 
@@ -34,14 +37,98 @@ def test_report_embargoed_items(mock_create_engine):
     now = datetime.now()
     mock_create_engine.return_value.connect.return_value.execute.return_value.fetchall.side_effect = [
         [["handle/1234", "item_id", now]],
-        {AUTHOR: "Tyler",
-         URI: "handle/1234",
-         TITLE: "Reporting Test",
-         ALTERNATIVE_TITLE: "How I learned to love testing",
-         DEPARTMENT: "Info"}
+        [("item_id", AUTHOR, "Tyler"),
+         ("item_id", URI, "handle/1234"),
+         ("item_id", TITLE, "Reporting Test"),
+         ("item_id", ALTERNATIVE_TITLE, "How I learned to love testing"),
+         ("item_id", DEPARTMENT, "Info")]
     ]
     assert report_embargoed_items("2019-09-01", "2019-09-30") == [['handle/1234', 'Tyler', 'Reporting Test', 'Info', now.isoformat()]]
 
+
+def test_report_embargoed_items_batches_metadata(mock_create_engine, mocker):
+    now = datetime.now()
+    mocker.patch('dspaceq.tasks.reports.METADATA_CHUNK_SIZE', 2)
+    execute = mock_create_engine.return_value.connect.return_value.execute
+    execute.return_value.fetchall.side_effect = [
+        [["handle/1", "item_1", now], ["handle/2", "item_2", now], ["handle/3", "item_3", now]],
+        [("item_1", AUTHOR, "One"), ("item_2", TITLE, "Two")],
+        [("item_3", DEPARTMENT, "Three")]
+    ]
+    assert report_embargoed_items("2019-09-01", "2019-09-30") == [
+        ['handle/1', 'One', 'Unknown', 'Unknown', now.isoformat()],
+        ['handle/2', 'Unknown', 'Two', 'Unknown', now.isoformat()],
+        ['handle/3', 'Unknown', 'Unknown', 'Three', now.isoformat()]]
+    assert execute.call_count == 3
+
+def test_report_embargoed_items_reuses_engine(mock_create_engine):
+    assert report_embargoed_items("2019-09-01", "2019-09-30") == []
+    assert report_embargoed_items("2019-10-01", "2019-10-31") == []
+    assert mock_create_engine.call_count == 1
+    assert mock_create_engine.call_args[1]["pool_pre_ping"] is True
+    connection = mock_create_engine.return_value.connect.return_value
+    assert connection.__exit__.call_count == 2
+
+
+def test_report_embargoed_items_collections(mock_create_engine):
+    now = datetime.now()
+    execute = mock_create_engine.return_value.connect.return_value.execute
+    execute.return_value.fetchall.side_effect = [
+        [["handle/1234", "item_id", now]],
+        [("item_id", AUTHOR, "Tyler"), ("item_id", TITLE, "Reporting Test"), ("item_id", DEPARTMENT, "Info")]
+    ]
+    assert report_embargoed_items("2019-09-01", "2019-09-30", collections=["11244/1"]) == [
+        ['handle/1234', 'Tyler', 'Reporting Test', 'Info', now.isoformat()]]
+    query, = execute.call_args_list[0][0]
+    assert query.element.text == startdate_collection_query
+    assert execute.call_args_list[0][1] == {"beg_date": "2019-09-01", "end_date": "2019-09-30", "collections": ("11244/1",)}
+    assert execute.call_count == 2
+
+
+def test_report_embargoed_items_explain(mock_create_engine):
+    execute = mock_create_engine.return_value.connect.return_value.execute
+    execute.return_value.fetchall.return_value = [("HashAggregate",), ("  ->  Hash Join",)]
+    assert report_embargoed_items("2019-09-01", "2019-09-30", explain=True) == {"plan": ["HashAggregate", "  ->  Hash Join"]}
+    query, = execute.call_args[0]
+    assert query.text == "explain analyze " + startdate_query
+    assert execute.call_count == 1
+
+
+def _mock_streamed_report(mock_create_engine):
+    now = datetime(2019, 9, 15)
+    connection = mock_create_engine.return_value.connect.return_value
+    connection.execution_options.return_value.execute.return_value.partitions.return_value = iter([
+        [["handle/1", "item_1", now], ["handle/2", "item_2", now]],
+        [["handle/3", "item_3", now]]
+    ])
+    connection.execute.return_value.fetchall.side_effect = [
+        [("item_1", AUTHOR, "One"), ("item_2", AUTHOR, "Two")],
+        [("item_3", AUTHOR, u"Thr\u00e9e")]
+    ]
+    return connection
+
+
+def test_report_embargoed_items_stream_jsonl(mock_create_engine, tmpdir):
+    connection = _mock_streamed_report(mock_create_engine)
+    output = str(tmpdir / "report.jsonl")
+    assert report_embargoed_items("2019-09-01", "2019-09-30", output=output, yield_per=2) == {"output": output, "rows": 3}
+    connection.execution_options.assert_called_with(stream_results=True)
+    connection.execution_options.return_value.execute.return_value.partitions.assert_called_with(2)
+    lines = io.open(output, encoding="utf-8").read().splitlines()
+    assert json.loads(lines[2]) == ["handle/3", u"Thr\u00e9e", "Unknown", "Unknown", "2019-09-15T00:00:00"]
+    assert connection.execute.call_count == 2  # one metadata query per partition
+
+
+def test_report_embargoed_items_stream_csv_s3(mock_create_engine, s3_test_bucket):
+    _mock_streamed_report(mock_create_engine)
+    bucket = os.environ['DEFAULT_BUCKET']
+    output = "s3://{0}/reports/embargo.csv".format(bucket)
+    assert report_embargoed_items("2019-09-01", "2019-09-30", output=output) == {"output": output, "rows": 3}
+    body = s3_test_bucket.get_object(Bucket=bucket, Key="reports/embargo.csv")["Body"].read().decode("utf-8")
+    assert body.splitlines()[0] == "handle/1,One,Unknown,Unknown,2019-09-15T00:00:00"
+    assert body.splitlines()[2] == u"handle/3,Thr\u00e9e,Unknown,Unknown,2019-09-15T00:00:00"
+
+
 def test_sqlalchemy_sql_template():
     template = "select * from :table;"
     result = "select * from %(table)s;"
@@ -1,9 +1,9 @@
 from genericpath import isfile
 import posix
-#from subprocess import CalledProcessError
 import sys
 from unittest import TestCase
 import os
+import stat
 
 from six import PY2
 
@@ -15,17 +15,24 @@ else:
     from pathlib import Path
 
 import pytest
+from lxml import etree
+from pymongo import UpdateOne
 from requests.exceptions import HTTPError
+from celery.signals import worker_ready
+from celery.utils.functional import head_from_fun
 
-from dspaceq.tasks.tasks import add, ingest_thesis_dissertation, dspace_ingest, notify_dspace_etd_loaded, list_missing_metadata_etd
+from dspaceq.tasks.tasks import add, ingest_thesis_dissertation, prepare_etd_bag, ingest_prepared_etds, dspace_ingest, notify_dspace_etd_loaded, list_missing_metadata_etd, \
+    backfill_digital_object_mmsids, update_alma_url_field, send_alma_url_digest, templates, notify_etd_missing_fields, \
+    app, _schedule, CATALOG_BACKFILL_INTERVAL
 
+from dspaceq.tasks import tasks
 from dspaceq.tasks.utils import FailedIngest
 
     
 def test_add():
     assert add(21, 21) == 42
     
-def test_dspace_ingest(tmpdir, mock_boto3, mock_mkdtemp, mock_check_call, mock_rmtree, mock_mkdir):
+def test_dspace_ingest(tmpdir, mock_boto3, mock_mkdtemp, mock_popen, mock_rmtree, mock_mkdir):
     mock_mkdtemp.return_value = str(tmpdir)
     mapfile = tmpdir / "mapfile"
     mapfile = Path(mapfile)
@@ -44,7 +51,8 @@ def test_dspace_ingest(tmpdir, mock_boto3, mock_mkdtemp, mock_check_call, mock_r
     mock_rmtree.assert_called_with(str(tmpdir))
     assert mock_rmtree.call_count == 1
     
-    mock_check_call.side_effect = FailedIngest('failed to ingest')
+    mock_popen.return_value.poll.return_value = 1
+    mock_popen.return_value.returncode = 1
     with pytest.raises(FailedIngest) as call_error:
             dspace_ingest(bag_details, collection="")
     assert call_error.type == FailedIngest
@@ -52,35 +60,310 @@ def test_dspace_ingest(tmpdir, mock_boto3, mock_mkdtemp, mock_check_call, mock_r
     mock_boto3.resource.assert_called_with('s3')
     mock_rmtree.assert_called_with(str(tmpdir))
     assert mock_rmtree.call_count == 2
- 
-def test_ingest_thesis_dissertation(mock_get_mmsid, mock_list_s3_files, mock_check_missing, mock_bib_metadata, mock_etree, mock_guess_collection, mock_celery_signature, mock_celery_group):
+
+def test_dspace_ingest_permissions(tmpdir, mock_boto3, mock_mkdtemp, mock_popen, mock_rmtree, mocker):
+    mock_mkdtemp.return_value = str(tmpdir)
+    tmpdir.join("mapfile").write("")
+    getgrnam = mocker.patch('dspaceq.tasks.utils.grp.getgrnam')
+    getgrnam.return_value.gr_gid = os.getgid()
+    chown = mocker.spy(os, 'chown')
+    bag_details = [{"bag name": {"files": ["file.pdf"], "metadata": "xml", "metadata_ou": "ou.xml"}}]
+    assert dspace_ingest(bag_details, collection="") == {"success": {}}
+    # only the import runs in a subprocess and only the temp root has its group changed
+    assert mock_popen.call_count == 1
+    assert "import" in mock_popen.call_args[0][0]
+    chown.assert_called_once_with(str(tmpdir), -1, os.getgid())
+    assert stat.S_IMODE(os.stat(str(tmpdir)).st_mode) == 0o2775
+    assert stat.S_IMODE(os.stat(str(tmpdir / "item_0")).st_mode) == 0o2775
+    for filename in ["contents", "dublin_core.xml", "metadata_ou"]:
+        assert stat.S_IMODE(os.stat(str(tmpdir / "item_0" / filename)).st_mode) & 0o660 == 0o660
+
+    getgrnam.side_effect = KeyError("tomcat")
+    mock_mkdtemp.return_value = str(tmpdir.mkdir("no_group"))
+    tmpdir.join("no_group", "mapfile").write("")
+    assert dspace_ingest(bag_details, collection="") == {"success": {}}
+    chown.assert_called_with(str(tmpdir / "no_group"), -1, -1)
+
+def test_dspace_ingest_restrictive_umask(tmpdir, s3_test_bucket, mock_boto3, mock_mkdtemp, mock_popen, mock_rmtree):
+    bucket = os.environ['DEFAULT_BUCKET']
+    key = 'private/shareok/bag/data/file.pdf'
+    s3_test_bucket.put_object(Bucket=bucket, Key=key, Body='pdf')
+    mock_boto3.resource.return_value.meta.client = s3_test_bucket
+    mock_mkdtemp.return_value = str(tmpdir)
+    tmpdir.join("mapfile").write("")
+    previous = os.umask(0o077)
+    try:
+        dspace_ingest([{"bag": {"files": [key], "metadata": "xml"}}], collection="")
+    finally:
+        os.umask(previous)
+    # the import runs as DSPACE_GROUP so every file it reads must be group readable
+    for filename in ["file.pdf", "contents", "dublin_core.xml"]:
+        assert stat.S_IMODE(os.stat(str(tmpdir / "item_0" / filename)).st_mode) == 0o664
+
+def test_dspace_ingest_progress(tmpdir, mock_boto3, mock_mkdtemp, mock_popen, mock_rmtree, mocker):
+    mock_mkdtemp.return_value = str(tmpdir)
+    mocker.patch('dspaceq.tasks.tasks.DSPACE_IMPORT_POLL', 0)
+    update_state = mocker.patch.object(dspace_ingest, 'update_state')
+    mapfile = tmpdir / "mapfile"
+    # the import writes one mapfile line between each poll - the last without a newline
+    writes = iter(["item_0 11244/1\nitem_1 11244", "/2\n", "item_2 11244/3"])
+
+    def poll():
+        try:
+            with open(str(mapfile), "a") as f:
+                f.write(next(writes))
+            return None
+        except StopIteration:
+            return 0
+    mock_popen.return_value.poll.side_effect = poll
+
+    bag_details = [{"bag_{0}".format(index): {"files": [], "metadata": "xml"}} for index in range(3)]
+    result = dspace_ingest.apply(args=(bag_details, ""), task_id="ingest-1").get()
+    assert result == {"success": {"bag_0": "11244/1", "bag_1": "11244/2", "bag_2": "11244/3"}}
+    states = [call[1]["meta"] for call in update_state.call_args_list]
+    assert [(meta["imported"], meta["total"], meta["current"]) for meta in states] == [
+        (1, 3, "bag_0"), (2, 3, "bag_1"), (3, 3, "bag_2")]
+    assert update_state.call_args[1]["state"] == "PROGRESS"
+
+def test_dspace_ingest_timings(tmpdir, mock_boto3, mock_mkdtemp, mock_popen, mock_rmtree, mocker):
+    mock_mkdtemp.return_value = str(tmpdir)
+    tmpdir.join("mapfile").write("item_0 11244/1")
+    mocker.patch('dspaceq.tasks.instrument.TASK_TIMINGS', True)
+    bag_details = [{"bag_0": {"files": ["private/shareok/bag_0/data/file.pdf"], "metadata": "xml"}}]
+    timings = dspace_ingest(bag_details, collection="")["timings"]
+    assert timings["stages"]["dspace_import"]["count"] == 1
+    assert timings["bags"]["bag_0"]["s3_download"]["count"] == 1
+
+@pytest.mark.parametrize("task", [dspace_ingest, ingest_thesis_dissertation, prepare_etd_bag, update_alma_url_field])
+def test_timed_tasks_check_arguments(task):
+    with pytest.raises(TypeError):
+        head_from_fun(task.run, bound=task.__bound__)(bogus=1)
+
+def test_dspace_ingest_chunked(tmpdir, mock_boto3, mock_mkdtemp, mock_popen, mock_rmtree, mocker):
+    mock_mkdtemp.return_value = str(tmpdir)
+    downloads = mocker.spy(tasks, 'download_s3_bags')
+    imported = []
+    failing = ["chunk_1"]
+
+    def dspace_import(args, **kwargs):
+        if "import" in args:
+            source_dir = args[args.index("-s") + 1]
+            items = sorted(item for item in os.listdir(source_dir) if item.startswith("item_"))
+            imported.append(items)
+            if os.path.basename(source_dir) in failing:
+                return Mock(returncode=1, **{"poll.return_value": 1})
+            with open(args[args.index("-m") + 1], "w") as f:
+                f.write("\n".join("{0} handle_{0}".format(item) for item in items))
+        return Mock(returncode=0, **{"poll.return_value": 0})
+    mock_popen.side_effect = dspace_import
+
+    bag_details = [{"bag_{0}".format(index): {"files": ["file.pdf"], "metadata": "xml"}} for index in range(5)]
+    assert dspace_ingest(bag_details, collection="", chunk_size=2) == {
+        "success": {"bag_0": "handle_item_0", "bag_1": "handle_item_1", "bag_4": "handle_item_4"},
+        "failed": {"bag_2": "failed to ingest", "bag_3": "failed to ingest"}}
+    assert sorted(imported) == [["item_0", "item_1"], ["item_2", "item_3"], ["item_4"]]
+    # every chunk downloads on one pool of S3_DOWNLOAD_WORKERS
+    executors = {id(call[1]["executor"]) for call in downloads.call_args_list}
+    assert len(executors) == 1 and downloads.call_args[1]["executor"] is not None
+    mock_rmtree.assert_any_call(str(tmpdir / "chunk_1"), ignore_errors=True)
+    mock_rmtree.assert_called_with(str(tmpdir))
+
+    mock_mkdtemp.return_value = str(tmpdir.mkdir("all_failed"))
+    failing.append("chunk_0")
+    with pytest.raises(FailedIngest):
+        dspace_ingest(bag_details[:2], collection="", chunk_size=1)
+
+def test_ingest_thesis_dissertation(mock_get_mmsid, mock_list_s3_files_batch, mock_check_missing, mock_get_bib_records, mock_celery_signature, mock_celery_group, mock_celery_chord):
     mock_get_mmsid.return_value = "9876543210987"
-    mock_list_s3_files.return_value = ['test.pdf', 'test.txt']
-    mock_bib_metadata[0].return_value = "9876543210987"
-    mock_etree.return_value = '<dc xmlns="http://www.loc.gov/MARC21/slim">test</dc>'
-    mock_guess_collection.return_value = 'TEST thesis'
+    mock_list_s3_files_batch.return_value = {'Smith_2019_9876543210987': ['test.pdf', 'test.txt']}
+    mock_get_bib_records.return_value = {"9876543210987": "9876543210987"}
 
     mock_check_missing.return_value = [(9876543210987, 'Test Error')]
     assert ingest_thesis_dissertation('Smith_2019_9876543210987') == {
         'Kicked off ingest': [], 'failed': {'Smith_2019_9876543210987': 'Missing required metadata in Alma - contact cataloging group'}
         }
+    assert not mock_celery_chord.called
     
     mock_check_missing.return_value = [(9876543210987,[])]
     assert ingest_thesis_dissertation('Smith_2019_9876543210987') == {'Kicked off ingest': ['Smith_2019_9876543210987'], 'failed': {}}
+    prepare = mock_celery_signature.call_args_list[0]
+    assert prepare[0][0] == "dspaceq.tasks.tasks.prepare_etd_bag"
+    assert prepare[1]["kwargs"]["collection"] == ""  # guessed from the Alma record by prepare_etd_bag
+
+    mock_celery_signature.reset_mock()
     assert ingest_thesis_dissertation('Smith_2019_9876543210987', 'TEST thesis') == {'Kicked off ingest': ['Smith_2019_9876543210987'], 'failed': {}}
+    prepare = mock_celery_signature.call_args_list[0]
+    assert prepare[1]["kwargs"] == {"bag": 'Smith_2019_9876543210987', "collection": 'TEST thesis',
+                                    "files": ['test.pdf', 'test.txt'], "bib_record": "9876543210987"}
+    mock_celery_chord.return_value.assert_called_with(mock_celery_signature.return_value)
+
+def test_prepare_etd_bag(mock_get_mmsid, mock_get_bib_records, mock_bib_metadata, mock_etree, mock_guess_collection):
+    mock_get_mmsid.return_value = "9876543210987"
+    mock_get_bib_records.return_value = {"9876543210987": "9876543210987"}
+    mock_etree.return_value = '<dc xmlns="http://www.loc.gov/MARC21/slim">test</dc>'
+    mock_guess_collection.return_value = 'TEST thesis'
+
+    assert prepare_etd_bag('Smith_2019_9876543210987', files=['test.pdf', 'test.txt']) == {
+        'bag': 'Smith_2019_9876543210987', 'collection': 'TEST thesis', 'files': ['test.pdf', 'test.txt'],
+        'metadata': '<dc xmlns="http://www.loc.gov/MARC21/slim">test</dc>'}
+    mock_get_bib_records.assert_called_with(["9876543210987"])
+    assert prepare_etd_bag('Smith_2019_9876543210987', 'Other', ['test.pdf'], "9876543210987")['collection'] == 'Other'
+
+    mock_get_bib_records.return_value = {"9876543210987": {"error": "Alma record not found: 9876543210987"}}
+    assert prepare_etd_bag('Smith_2019_9876543210987', files=[]) == {
+        'bag': 'Smith_2019_9876543210987', 'error': {"error": "Alma record not found: 9876543210987"}}
+
+    mock_bib_metadata[1].side_effect = ValueError("bad record")
+    assert prepare_etd_bag('Smith_2019_9876543210987', files=[], bib_record="9876543210987") == {
+        'bag': 'Smith_2019_9876543210987', 'error': 'Failed to prepare metadata: bad record'}
+
+def test_ingest_prepared_etds(mock_celery_signature, mock_celery_group):
+    prepared = [{'bag': 'Smith_2019_1', 'collection': 'thesis', 'files': ['a.pdf'], 'metadata': '<dc/>'},
+                {'bag': 'Jones_2019_2', 'error': 'Incompatible character found in abstract.txt'},
+                {'bag': 'Brown_2019_3', 'collection': 'dissertation', 'files': ['b.pdf'], 'metadata': '<dc/>'},
+                {'bag': 'Green_2019_4', 'collection': 'thesis', 'files': ['c.pdf'], 'metadata': '<dc/>'}]
+    assert ingest_prepared_etds(prepared, failed={'White_2019_5': 'Missing'}) == {
+        'Kicked off ingest': ['Smith_2019_1', 'Brown_2019_3', 'Green_2019_4'],
+        'failed': {'White_2019_5': 'Missing', 'Jones_2019_2': 'Incompatible character found in abstract.txt'}}
+    ingests = [call[1]["kwargs"] for call in mock_celery_signature.call_args_list
+               if call[0][0] == "dspaceq.tasks.tasks.dspace_ingest"]
+    assert ingests == [{"collection": "thesis", "bag_details": [{'Smith_2019_1': {'files': ['a.pdf'], 'metadata': '<dc/>'}},
+                                                                {'Green_2019_4': {'files': ['c.pdf'], 'metadata': '<dc/>'}}]},
+                       {"collection": "dissertation", "bag_details": [{'Brown_2019_3': {'files': ['b.pdf'], 'metadata': '<dc/>'}}]}]
         
-def test_list_missing_metadata_etd(mock_get_mmsid, mock_check_missing, mock_get_digitized_bags,mock_get_requested_etds):
+def test_list_missing_metadata_etd(mock_get_mmsid, mock_check_missing, mock_get_digitized_bags,mock_get_requested_mmsids):
     mock_check_missing.return_value = [(9876543210987, 'Test Error')]
     assert list_missing_metadata_etd('Smith_2019_9876543210987') == [(9876543210987, 'Test Error')]
     mock_check_missing.return_value = [(9876543210987,[])]
 
-    mock_get_requested_etds.return_value = []
+    mock_get_requested_mmsids.return_value = []
     mock_get_digitized_bags.return_value = []
     mock_get_mmsid.return_value = "9876543210987"
     assert list_missing_metadata_etd('') == "No items found ready for ingest"
-    mock_get_requested_etds.assert_called_with('.*')
+    mock_get_digitized_bags.assert_called_with([])
         
     
+def test_backfill_digital_object_mmsids(mocker):
+    backend = mocker.patch('dspaceq.tasks.utils.Celery.backend')
+    digital_objects = backend.database.client.catalog.digital_objects
+    digital_objects.find.return_value = [{'_id': 1, 'bag': 'shareok/Smith_2019_9876543210987'},
+                                         {'_id': 2, 'bag': 'shareok/Jones_2018_1234567890123'},
+                                         {'_id': 3, 'bag': 'shareok/no_mmsid'}]
+    digital_objects.bulk_write.return_value.modified_count = 2
+    assert backfill_digital_object_mmsids(batch_size=2) == "Updated mmsid for 4 records"
+    first_batch, second_batch = [call[0][0] for call in digital_objects.bulk_write.call_args_list]
+    assert first_batch[0] == UpdateOne({'_id': 1}, {'$set': {'mmsid': '9876543210987'}})
+    assert second_batch == [UpdateOne({'_id': 3}, {'$set': {'mmsid': None}})]
+    digital_objects.create_index.assert_any_call([('mmsid', 1)])
+
+def test_backfill_digital_object_mmsids_scheduled():
+    entry = app.conf.beat_schedule["backfill-digital-object-mmsids"]
+    assert entry["task"] == "dspaceq.tasks.tasks.backfill_digital_object_mmsids"
+    assert entry["schedule"] == CATALOG_BACKFILL_INTERVAL
+
+def test_backfill_on_worker_ready(mocker):
+    apply_async = mocker.patch.object(backfill_digital_object_mmsids, 'apply_async')
+    worker_ready.send(sender=None)
+    apply_async.assert_called_once_with(queue=tasks.QUEUE_NAME)
+
+def test_schedule():
+    original = app.conf.beat_schedule
+    app.conf.beat_schedule = {"send-alma-url-digest": {"task": "configured", "schedule": 60}}
+    try:
+        _schedule("send-alma-url-digest", "dspaceq.tasks.tasks.send_alma_url_digest", 3600)
+        _schedule("backfill-digital-object-mmsids", "dspaceq.tasks.tasks.backfill_digital_object_mmsids", 600)
+        assert app.conf.beat_schedule["send-alma-url-digest"] == {"task": "configured", "schedule": 60}  # celeryconfig wins
+        assert app.conf.beat_schedule["backfill-digital-object-mmsids"]["schedule"] == 600
+    finally:
+        app.conf.beat_schedule = original
+
+def test_update_alma_url_field(mock_alma_session, mock_celery_signature):
+    bib_record = open(str(Path(__file__).parent / "data/example_bib_record_with_url_field.xml"), "rb").read()
+    other_record = open(str(Path(__file__).parent / "data/example_bib_record.xml"), "rb").read()
+    bibs = etree.Element("bibs")
+    bibs.append(etree.fromstring(bib_record))
+    bibs.append(etree.fromstring(other_record))
+
+    def alma_response(method, url, **kwargs):
+        if method == "GET":
+            return Mock(status_code=200, content=etree.tostring(bibs))
+        if "/99263190402042?" in url:
+            return Mock(status_code=400)
+        return Mock(status_code=200)
+    mock_alma_session.request.side_effect = alma_response
+    args = {"success": {"Smith_2015_99551580502042": "https://shareok.org/11244/1",
+                        "Napier_1614_99263190402042": "https://shareok.org/11244/2",
+                        "Missing_2019_99999999902042": "https://shareok.org/11244/3"}}
+    assert update_alma_url_field(args) == {
+        'success': [["Smith_2015_99551580502042", "https://shareok.org/11244/1"]],
+        'fail': [["Napier_1614_99263190402042", "Could not update record"],
+                 ["Missing_2019_99999999902042", "Could not access alma"]]}
+    put = [call for call in mock_alma_session.request.call_args_list if call[0][0] == "PUT" and "/99551580502042?" in call[0][1]][0]
+    assert b"https://shareok.org/11244/1" in put[1]["data"]
+    assert mock_celery_signature.call_args[1]["kwargs"]["body"].endswith(
+        "from: https://shareok.org/11244/325437\nto: https://shareok.org/11244/1")
+    assert mock_celery_signature.return_value.delay.call_count == 1
+
+def _mock_alma_updates(mock_alma_session):
+    bibs = etree.Element("bibs")
+    for filename in ["example_bib_record_with_url_field.xml", "example_bib_record.xml"]:
+        bibs.append(etree.fromstring(open(str(Path(__file__).parent / "data" / filename), "rb").read()))
+    mock_alma_session.request.side_effect = lambda method, url, **kwargs: Mock(status_code=200, content=etree.tostring(bibs))
+    return {"success": {"Smith_2015_99551580502042": "https://shareok.org/11244/1",
+                        "Napier_1614_99263190402042": "https://shareok.org/11244/2"}}
+
+def test_update_alma_url_field_digest(mock_alma_session, mock_celery_signature):
+    args = _mock_alma_updates(mock_alma_session)
+    assert len(update_alma_url_field(args, digest=True)['success']) == 2
+    assert mock_celery_signature.return_value.delay.call_count == 1
+    body = mock_celery_signature.call_args[1]["kwargs"]["body"]
+    assert "mmsid: 99551580502042\nfrom: https://shareok.org/11244/325437\nto: https://shareok.org/11244/1" in body
+    assert "mmsid: 99263190402042\nfrom: None\nto: https://shareok.org/11244/2" in body
+
+def test_update_alma_url_field_digest_window(mock_alma_session, mock_celery_signature, mock_tasks_backend, mocker):
+    mocker.patch('dspaceq.tasks.tasks.ALMA_DIGEST_WINDOW', 3600)
+    args = _mock_alma_updates(mock_alma_session)
+    update_alma_url_field(args, digest=True)
+    assert not mock_celery_signature.return_value.delay.called
+    queued = mock_tasks_backend.database.client.catalog.alma_url_digest.insert_many.call_args[0][0]
+    assert [change["mmsid"] for change in queued] == ["99551580502042", "99263190402042"]
+
+def test_send_alma_url_digest(mock_celery_signature, mock_tasks_backend):
+    digest = mock_tasks_backend.database.client.catalog.alma_url_digest
+    digest.find.return_value.sort.return_value = []
+    assert send_alma_url_digest() == "No Alma URL changes to send"
+    digest.find.return_value.sort.return_value = [
+        {"_id": 1, "mmsid": "99551580502042", "old_url": None, "new_url": "https://shareok.org/11244/1"}]
+    assert send_alma_url_digest() == "Sent Alma URL digest of 1 changes"
+    assert mock_celery_signature.return_value.delay.call_count == 1
+    digest.delete_many.assert_called_with({"_id": {"$in": [1]}})
+
+def test_email_templates():
+    assert templates.get_template("etd_loaded.txt") is templates.get_template("etd_loaded.txt")
+    msg = templates.get_template("etd_missing_fields.txt").render(
+        bags={"Smith_2019_9876543210987": {"mmsid": "9876543210987", "missing": ["690: School"]}})
+    assert msg == ("The following ETD requests have missing fields:\n"
+                   "The bags are accessible on norfile: ul-bagit\\shareok\\*\n"
+                   "========================\n"
+                   "  bag: Smith_2019_9876543210987\n"
+                   "  mmsid: 9876543210987\n"
+                   "  Missing Details:\n"
+                   "    690: School\n")
+
+def test_notify_etd_missing_fields(mocker, mock_get_digitized_bags, mock_check_missing, mock_celery_signature):
+    mocker.patch('dspaceq.tasks.tasks.get_requested_mmsids')
+    mock_get_digitized_bags.return_value = ['Smith_2019_9876543210987', 'Smith_2019_9876543210987_ver2',
+                                            'Jones_2018_1234567890123']
+    mock_check_missing.return_value = [('9876543210987', ['690: School']), ('9876543210987', ['690: School']),
+                                       ('1234567890123', [])]
+    assert notify_etd_missing_fields() == "Notification Sent"
+    body = mock_celery_signature.call_args[1]["kwargs"]["body"]
+    assert "bag: Smith_2019_9876543210987_ver2\n  mmsid: 9876543210987" in body
+    assert "Jones_2018_1234567890123" not in body
+
+    mock_check_missing.return_value = [('9876543210987', []), ('9876543210987', []), ('1234567890123', [])]
+    assert notify_etd_missing_fields() == "No Missing Details"
+
 def test_notify_dspace_etd_loaded():    
     arg = {'success': {}}
     assert notify_dspace_etd_loaded(arg) == "No items to ingest - no notification sent"
@@ -88,22 +371,35 @@ def test_notify_dspace_etd_loaded():
     arg = {'success': {'bagname': 'url'}}
     #assert notify_dspace_etd_loaded(arg) == "Ingest notification sent"
 
-def test_ingest_thesis_dissertation_mock_s3(s3_resource, mock_get_mmsid, mock_check_missing, mock_get_bib_record, mock_celery_signature, mock_celery_group, s3_test_bucket):
+def test_notify_dspace_etd_loaded_requests(mock_get_requested_etds, mock_celery_signature):
+    mock_get_requested_etds.return_value = [{"mmsid": "9876543210987", "name": "Requester"}]
+    assert notify_dspace_etd_loaded({'success': {'Smith_2019_9876543210987': 'https://shareok.org/11244/1'}}) == "Ingest notification sent"
+    mock_get_requested_etds.assert_called_with(["9876543210987"])
+    assert "URL: https://shareok.org/11244/1" in mock_celery_signature.call_args[1]["kwargs"]["body"]
+
+def test_prepare_etd_bag_mock_s3(s3_resource, mock_get_mmsid, mock_get_bib_records, s3_test_bucket, mocker):
     bucket = os.environ['DEFAULT_BUCKET']
     bag_name = "Smith_1819_12345678890123"
 
-    mock_check_missing.return_value = [("1234567890123", [])]
-    mock_get_bib_record.return_value = open(str(Path(__file__).parent / "data/example_bib_record.xml"), "rb").read()
+    mock_get_mmsid.return_value = "12345678890123"
+    mock_get_bib_records.return_value = {"12345678890123": open(str(Path(__file__).parent / "data/example_bib_record.xml"), "rb").read()}
     s3_test_bucket.put_object(Bucket=bucket, Key='private/shareok/{0}/data/committee.txt'.format(bag_name), Body='John Smith')
     s3_test_bucket.put_object(Bucket=bucket, Key='private/shareok/{0}/data/abstract.txt'.format(bag_name), Body='test abstract')
     
     #Test with good bag setting
     assert s3_resource.Object(bucket, 'private/shareok/{0}/data/committee.txt'.format(bag_name)).get()['Body'].read() == b'John Smith'
-    assert ingest_thesis_dissertation(bag_name) == {'Kicked off ingest': [bag_name], 'failed': {}}
+    prepared = prepare_etd_bag(bag_name)
+    assert prepared['files'] == []
+    assert b'<dcvalue element="contributor" qualifier="committeeMember">John Smith</dcvalue>' in prepared['metadata']
+    assert b'<dcvalue element="description" qualifier="abstract">test abstract</dcvalue>' in prepared['metadata']
     
     #Test with invalid control character in abstract
     s3_test_bucket.put_object(Bucket=bucket, Key='private/shareok/{0}/data/abstract.txt'.format(bag_name), Body=open(str(Path(__file__).parent / "data/example_abstract_control_char.txt"), "rb").read())
-    assert ingest_thesis_dissertation(bag_name) == {'Kicked off ingest': [], 'failed': {bag_name: 'Incompatible character found in abstract.txt'}}
+    assert prepare_etd_bag(bag_name) == {'bag': bag_name, 'error': 'Incompatible character found in abstract.txt'}
+
+    #Test with oversized abstract
+    mocker.patch('dspaceq.tasks.utils.S3_TEXT_MAX_BYTES', 10)
+    assert prepare_etd_bag(bag_name) == {'bag': bag_name, 'error': 'abstract.txt exceeds size limit'}
     
 
 
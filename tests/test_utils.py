@@ -1,14 +1,22 @@
 # -*- coding: utf-8 -*-
 import sys
+import stat
+import datetime
+import time
 import os
 from bson.objectid import ObjectId
 import pytest
 from lxml import etree
-from lxml.etree import XMLSyntaxError
+from lxml.etree import DocumentInvalid
 import pkg_resources
 import logging
 from six import PY2, ensure_text
 import boto3
+from boto3.exceptions import RetriesExceededError
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 
 if PY2:
@@ -23,9 +31,12 @@ import requests
 from requests import codes, ConnectionError, ConnectTimeout
 
 from dspaceq.tasks.utils import get_mmsid, get_bags, get_requested_mmsids, \
-    get_requested_etds, get_bib_record, check_missing, missing_fields, get_digitized_bags, get_alma_url_field,\
-    get_marc_from_bib, update_ingest_status, list_s3_files, chunk_list, guess_collection, marc_xml_to_dc_xml, validate_marc,\
-    bib_to_dc
+    get_requested_etds, get_bib_record, get_bib_records, check_missing, missing_fields, get_digitized_bags, get_alma_url_field,\
+    get_marc_from_bib, ensure_catalog_indexes, update_ingest_status, update_ingest_statuses, list_s3_files, list_s3_files_batch, read_s3_text, read_s3_texts, S3ObjectTooLarge, chunk_list, guess_collection, marc_xml_to_dc_xml, validate_marc,\
+    bib_to_dc, alma_request, AlmaQuotaExceeded, TokenBucket, count_alma_request, worker_processes, BibRecordCache, bib_cache, download_s3_bags, StagingCache, get_xml_resource, reload_xml_resources, get_xml_timings, MARC2DC_XSLT, MARC21_XSD
+from dspaceq.tasks.instrument import get_stage_totals
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.signals import worker_init
         
 
 from bson.objectid import ObjectId
@@ -137,6 +148,7 @@ def test_get_requested_mmsids(mock_celery_backend):
     mock_celery_backend.database.client.catalog.etd.find.return_value = result
     response = get_requested_mmsids()
     assert response == ["9876543210123", "3210123456789"]
+    mock_celery_backend.database.client.catalog.etd.find.assert_called_with({}, {'mmsid': 1, '_id': 0})
 
 def test_get_requested_mmsids_no_results(mock_celery_backend):
     result = []
@@ -162,6 +174,12 @@ def test_get_requested_etds(mock_celery_backend):
     response = get_requested_etds("9876543210123")
     #assert response == result
 
+def test_get_requested_etds_by_list(mock_celery_backend):
+    etd = mock_celery_backend.database.client.catalog.etd
+    etd.find.return_value = [{"mmsid": "9876543210123"}]
+    assert get_requested_etds(["9876543210123", "3210123456789"]) == [{"mmsid": "9876543210123"}]
+    etd.find.assert_called_with({'mmsid': {'$in': ["9876543210123", "3210123456789"]}})
+
 def test_get_requested_etds_no_results(mock_celery_backend):
     result = []
     mmsid = None
@@ -169,43 +187,43 @@ def test_get_requested_etds_no_results(mock_celery_backend):
     response = get_requested_etds(mmsid)
     assert response == []
 
-def test_get_bib_record(mock_requests_get):
-    mock_requests_get.return_value = Mock(status_code=codes.OK, content="testing ascii")
+def test_get_bib_record(mock_alma_session):
+    mock_alma_session.request.return_value = Mock(status_code=codes.OK, content="testing ascii")
     assert get_bib_record("placeholder_mmsid") == "testing ascii"
-    mock_requests_get.return_value = Mock(status_code=codes.OK, content=u"testing ascii in unicode string")
+    mock_alma_session.request.return_value = Mock(status_code=codes.OK, content=u"testing ascii in unicode string")
     assert get_bib_record("placeholder_mmsid") == u"testing ascii in unicode string"
-    mock_requests_get.return_value = Mock(status_code=codes.OK, content="testing unicode ☕ in ascii")
+    mock_alma_session.request.return_value = Mock(status_code=codes.OK, content="testing unicode ☕ in ascii")
     assert get_bib_record("placeholder_mmsid") == "testing unicode ☕ in ascii"
-    mock_requests_get.return_value = Mock(status_code=codes.OK, content=u"testing unicode ☕")
+    mock_alma_session.request.return_value = Mock(status_code=codes.OK, content=u"testing unicode ☕")
     assert get_bib_record("placeholder_mmsid") == u"testing unicode ☕"
-    mock_requests_get.return_value = Mock(status_code=200, content="testing ascii")
+    mock_alma_session.request.return_value = Mock(status_code=200, content="testing ascii")
     assert get_bib_record("placeholder_mmsid") == "testing ascii"
-    mock_requests_get.return_value = Mock(status_code=200, content=u"testing ascii in unicode string")
+    mock_alma_session.request.return_value = Mock(status_code=200, content=u"testing ascii in unicode string")
     assert get_bib_record("placeholder_mmsid") == u"testing ascii in unicode string"
-    mock_requests_get.return_value = Mock(status_code=200, content="testing unicode ☕ in ascii")
+    mock_alma_session.request.return_value = Mock(status_code=200, content="testing unicode ☕ in ascii")
     assert get_bib_record("placeholder_mmsid") == "testing unicode ☕ in ascii"
-    mock_requests_get.return_value = Mock(status_code=200, content=u"testing unicode ☕")
+    mock_alma_session.request.return_value = Mock(status_code=200, content=u"testing unicode ☕")
     assert get_bib_record("placeholder_mmsid") == u"testing unicode ☕"
 
-def test_get_bib_record_not_ok_status(mock_requests_get):
-    mock_requests_get.return_value = Mock(status_code=400)
+def test_get_bib_record_not_ok_status(mock_alma_session):
+    mock_alma_session.request.return_value = Mock(status_code=400)
     assert get_bib_record("placeholder_mmsid") == {"error": "Alma server returned code: 400"}
-    mock_requests_get.return_value = Mock(status_code=403)
+    mock_alma_session.request.return_value = Mock(status_code=403)
     assert get_bib_record("placeholder_mmsid") == {"error": "Alma server returned code: 403"}
-    mock_requests_get.return_value = Mock(status_code=404)
+    mock_alma_session.request.return_value = Mock(status_code=404)
     assert get_bib_record("placeholder_mmsid") == {"error": "Alma server returned code: 404"}
-    mock_requests_get.return_value = Mock(status_code=500)
+    mock_alma_session.request.return_value = Mock(status_code=500)
     assert get_bib_record("placeholder_mmsid") == {"error": "Alma server returned code: 500"}
 
-def test_get_bib_record_connection_issues(mock_requests_get):
-    mock_requests_get.side_effect = ConnectTimeout()
+def test_get_bib_record_connection_issues(mock_alma_session):
+    mock_alma_session.request.side_effect = ConnectTimeout()
     assert get_bib_record("placeholder_mmsid") == {"error": "Alma Connection Error - try again later."}
-    mock_requests_get.side_effect = ConnectionError()
+    mock_alma_session.request.side_effect = ConnectionError()
     assert get_bib_record("placeholder_mmsid") == {"error": "Alma Connection Error - try again later."}  
 
 @pytest.mark.parametrize("number", range(5))
-def test_check_missing_with_missing_metadata(mock_utils_get_bib_record, number):
-    mock_utils_get_bib_record.return_value = open(str(Path(__file__).parent / "data/example_bib_record.xml"), "rb").read()
+def test_check_missing_with_missing_metadata(mock_utils_get_bib_records, number):
+    mock_utils_get_bib_records.return_value = {"99263190402042": open(str(Path(__file__).parent / "data/example_bib_record.xml"), "rb").read()}
     assert check_missing("99263190402042") == [('99263190402042', [ensure_text('502a: Thesis/Diss Tag'), ensure_text('690: School')])]
 
 def test_missing_fields():
@@ -239,18 +257,58 @@ def test_missing_fields():
     bib_record = open(str(Path(__file__).parent / "data/missing_fields/example_title.xml"), "rb").read()
     assert missing_fields(bib_record) == [ensure_text('245: Title')]
 
-def test_get_bib_record(mock_requests_get):
-    mock_requests_get.return_value = Mock(status_code=200, content="testing ascii")
+def test_get_bib_record(mock_alma_session):
+    mock_alma_session.request.return_value = Mock(status_code=200, content="testing ascii")
     assert get_bib_record('123') == 'testing ascii'
     
-    mock_requests_get.side_effect = ConnectionError('Connection Error')
+    mock_alma_session.request.side_effect = ConnectionError('Connection Error')
     assert get_bib_record('123') == {"error": "Alma Connection Error - try again later."}
     assert requests.codes.ok == 200
 
-    mock_requests_get.side_effect = None
-    mock_requests_get.return_value = Mock(status_code=404, content="testing ascii")
+    mock_alma_session.request.side_effect = None
+    mock_alma_session.request.return_value = Mock(status_code=404, content="testing ascii")
     assert get_bib_record('123') == {"error": "Alma server returned code: 404"}
 
+def test_check_missing_with_bib_records(mock_utils_get_bib_records):
+    bib_records = {"99263190402042": open(str(Path(__file__).parent / "data/example_bib_record.xml"), "rb").read(),
+                   "99150680602042": {"error": "Alma server returned code: 400"}}
+    results = check_missing(["99263190402042", "99150680602042", None], bib_records)
+    assert results[0] == ('99263190402042', [ensure_text('502a: Thesis/Diss Tag'), ensure_text('690: School')])
+    assert list(results[1][1]) == ["Alma server returned code: 400"]
+    assert results[2] == (None, ["Could not find record!"])
+    assert not mock_utils_get_bib_records.called
+
+def _bibs_response(*filenames):
+    """ builds an Alma /bibs response from example bib records """
+    bibs = etree.Element("bibs", total_record_count=str(len(filenames)))
+    for filename in filenames:
+        bibs.append(etree.fromstring(open(str(Path(__file__).parent / "data" / filename), "rb").read()))
+    return etree.tostring(bibs, xml_declaration=True, encoding="UTF-8", standalone=True)
+
+def test_get_bib_records(mock_alma_session):
+    mock_alma_session.request.return_value = Mock(status_code=200, content=_bibs_response(
+        "example_bib_record.xml", "example_bib_record_with_url_field.xml"))
+    bib_records = get_bib_records(["99263190402042", "99551580502042", "99263190402042", "99999999902042", None])
+    assert mock_alma_session.request.call_count == 1
+    assert "mms_id=99263190402042,99551580502042,99999999902042&" in mock_alma_session.request.call_args[0][1]
+    assert missing_fields(bib_records["99263190402042"]) == [ensure_text('502a: Thesis/Diss Tag'), ensure_text('690: School')]
+    assert get_alma_url_field(bib_records["99551580502042"]) == 'https://shareok.org/11244/325437'
+    assert bib_records["99999999902042"] == {"error": "Alma record not found: 99999999902042"}
+    assert bib_records[None] is None
+
+def test_get_bib_records_batches(mock_alma_session):
+    mock_alma_session.request.return_value = Mock(status_code=200, content=_bibs_response())
+    get_bib_records([str(mmsid) for mmsid in range(10000000, 10000250)])
+    assert mock_alma_session.request.call_count == 3
+    requested = sorted(call[0][1].split("mms_id=")[1].split("&")[0] for call in mock_alma_session.request.call_args_list)
+    assert [len(mmsids.split(",")) for mmsids in requested] == [100, 100, 50]
+
+def test_get_bib_records_errors(mock_alma_session):
+    mock_alma_session.request.return_value = Mock(status_code=400)
+    assert get_bib_records(["99263190402042"]) == {"99263190402042": {"error": "Alma server returned code: 400"}}
+    mock_alma_session.request.side_effect = ConnectionError()
+    assert get_bib_records(["99263190402042"]) == {"99263190402042": {"error": "Alma Connection Error - try again later."}}
+
 def test_get_marc_from_bib():
     bib_record = open(str(Path(__file__).parent / "data/example_bib_record.xml"), "rb").read()
     record = open(str(Path(__file__).parent / "data/example_marc.xml"), "rb").read()
@@ -264,13 +322,47 @@ def test_get_digitized_bags(mock_celery_backend):
                'locations.s3.exists': True,
                }
               ]
+    results.append({'bag': 'shareok/indexed_123456789', 'mmsid': '123456789'})
+    results.append({'bag': 'shareok/indexed_123456789_ver2', 'mmsid': '123456789'})
+    results.append({'bag': 'shareok/bagname_123456789_ver2'})
     mock_celery_backend.database.client.catalog.digital_objects.find.return_value = results
-    assert get_digitized_bags('123456789') == ['bagname_123456789', 'digitized']
+    # records without the mmsid field are matched on the bag name, versioned copies are left out
+    assert get_digitized_bags('123456789') == ['bagname_123456789', 'indexed_123456789']
+    query = mock_celery_backend.database.client.catalog.digital_objects.find.call_args[0][0]
+    assert query['$or'][0] == {'mmsid': {'$in': ['123456789']}, 'bag': {'$regex': '^share'}}
+    assert query['$or'][1] == {'mmsid': {'$exists': False}, 'bag': {'$regex': '^share.*(?:123456789)$'}}
+    assert query['application.dspace.ingested'] == {'$ne': True}
+    assert get_digitized_bags([]) == []
+
+def test_ensure_catalog_indexes(mock_celery_backend):
+    ensure_catalog_indexes()
+    mock_celery_backend.database.client.catalog.digital_objects.create_index.assert_any_call([('mmsid', 1)])
+    mock_celery_backend.database.client.catalog.etd.create_index.assert_any_call([('mmsid', 1)])
     
 def test_update_ingest_status(mock_celery_backend):
-    mock_celery_backend.database.client.catalog.digital_objects.find_one.return_value = {'bag':'shareok/bagname', '_id': 'aaaaaaaaaaaaaaaaaaaaaaaa'}
-    mock_celery_backend.database.client.catalog.digital_objects.update.return_value = {'nModified': 1}
+    digital_objects = mock_celery_backend.database.client.catalog.digital_objects
+    digital_objects.find.return_value = [{'bag':'shareok/bagname', '_id': 'aaaaaaaaaaaaaaaaaaaaaaaa'}]
     assert update_ingest_status('bagname','url', application='dspace', project=None, ingested=True) == None
+    assert digital_objects.bulk_write.call_count == 1
+
+def test_update_ingest_statuses(mock_celery_backend):
+    digital_objects = mock_celery_backend.database.client.catalog.digital_objects
+    digital_objects.find.return_value = [{'bag': 'shareok/bag_9876543210987'}, {'bag': 'shareok/bag_two'}]
+    digital_objects.bulk_write.side_effect = BulkWriteError({'writeErrors': [{'index': 1, 'errmsg': 'write failed'}]})
+    status = update_ingest_statuses({'bag_9876543210987': 'url1', 'shareok/bag_two': 'url2', 'missing_bag': 'url3'},
+                                    application='dspace', project='etd')
+    assert status == {'updated': ['bag_9876543210987'], 'not_found': ['missing_bag'],
+                      'failed': {'shareok/bag_two': 'write failed'}}
+    assert digital_objects.find.call_args[0][0] == {
+        'bag': {'$in': ['shareok/bag_9876543210987', 'shareok/bag_two', 'shareok/missing_bag']}, 'project': 'etd'}
+    updates = digital_objects.bulk_write.call_args[0][0]
+    assert updates[0] == UpdateOne({'bag': 'shareok/bag_9876543210987', 'project': 'etd'}, {'$set': {
+        'application.dspace.ingested': True,
+        'application.dspace.url': 'url1',
+        'application.dspace.datetime': updates[0]._doc['$set']['application.dspace.datetime'],
+        'mmsid': '9876543210987'}})
+    assert digital_objects.bulk_write.call_args[1] == {'ordered': False}
+    assert update_ingest_statuses({}) == {'updated': [], 'not_found': [], 'failed': {}}
 
 def test_list_s3_files(s3_test_bucket):
     bucket = os.getenv('DEFAULT_BUCKET')
@@ -279,6 +371,42 @@ def test_list_s3_files(s3_test_bucket):
     s3_test_bucket.put_object(Bucket=bucket, Key='private/shareok/{0}/data/image.pdf'.format(bag), Body='test2')
     assert sorted(list_s3_files(bag)) == ['private/shareok/testbag/data/image.pdf', 'private/shareok/testbag/data/image.txt']
     
+def test_list_s3_files_paginated(s3_test_bucket):
+    bucket = os.getenv('DEFAULT_BUCKET')
+    bag = 'bigbag'
+    for index in range(1005):
+        s3_test_bucket.put_object(Bucket=bucket, Key='private/shareok/{0}/data/page_{1:04d}.pdf'.format(bag, index), Body='')
+    files = list_s3_files(bag)
+    assert len(files) == 1005
+    assert files[-1] == 'private/shareok/bigbag/data/page_1004.pdf'
+
+def test_list_s3_files_empty(s3_test_bucket):
+    assert list_s3_files('missingbag') == []
+
+def test_list_s3_files_batch(s3_test_bucket):
+    bucket = os.getenv('DEFAULT_BUCKET')
+    for bag in ['bag_1', 'bag_2']:
+        s3_test_bucket.put_object(Bucket=bucket, Key='private/shareok/{0}/data/{0}.pdf'.format(bag), Body='')
+    assert list_s3_files_batch(['bag_1', 'bag_2', 'bag_3']) == {
+        'bag_1': ['private/shareok/bag_1/data/bag_1.pdf'],
+        'bag_2': ['private/shareok/bag_2/data/bag_2.pdf'],
+        'bag_3': []}
+    assert list_s3_files_batch([]) == {}
+
+def test_read_s3_texts(s3_test_bucket, mocker):
+    bucket = os.getenv('DEFAULT_BUCKET')
+    s3_test_bucket.put_object(Bucket=bucket, Key='bag/committee.txt', Body='John Smith\nJane Doe')
+    # multibyte characters split across chunk boundaries
+    s3_test_bucket.put_object(Bucket=bucket, Key='bag/abstract.txt', Body=u'r\u00e9sum\u00e9 \u2713'.encode('utf-8'))
+    mocker.patch('dspaceq.tasks.utils.S3_TEXT_CHUNKSIZE', 1)
+    assert read_s3_texts(['bag/committee.txt', 'bag/abstract.txt']) == {
+        'bag/committee.txt': 'John Smith\nJane Doe', 'bag/abstract.txt': u'r\u00e9sum\u00e9 \u2713'}
+    assert read_s3_texts([]) == {}
+    with pytest.raises(S3ObjectTooLarge):
+        read_s3_text('bag/committee.txt', max_bytes=10)
+    with pytest.raises(S3ObjectTooLarge):
+        read_s3_texts(['bag/abstract.txt', 'bag/committee.txt'], max_bytes=15)
+
 def test_chunk_list():
     _list = [1,2,3,4,5,6,7,8,9,10]
     assert list(chunk_list(_list, 3)) == [[1,2,3], [4,5,6], [7,8,9], [10]]
@@ -300,10 +428,20 @@ def test_validate_marc():
     bib_record = open(str(Path(__file__).parent / "data/example_bib_record.xml"), "rb").read()
     record = open(str(Path(__file__).parent / "data/example_marc.xml"), "rb").read()
     bib_record_etree = etree.fromstring(bib_record)
-    with pytest.raises(XMLSyntaxError):
+    with pytest.raises(DocumentInvalid):
         validate_marc(bib_record_etree)
     record_etree = etree.fromstring(record)
+    assert validate_marc(record_etree) is record_etree
     assert etree.tostring(validate_marc(record_etree)) == record
+    # records from get_marc_from_bib are namespaced without reparsing
+    assert etree.tostring(validate_marc(get_marc_from_bib(bib_record))) == record
+
+def test_bib_to_dc_parses_once(mocker):
+    bib_record = open(str(Path(__file__).parent / "data/example_bib_record.xml"), "rb").read()
+    reload_xml_resources()
+    parses = [mocker.spy(etree, name) for name in ("fromstring", "XML", "parse")]
+    bib_to_dc(bib_record)
+    assert sum(parse.call_count for parse in parses) == 1
 
 def test_bib_to_dc():
     bib_record = open(str(Path(__file__).parent / "data/example_bib_record.xml"), "rb").read()
@@ -313,4 +451,328 @@ def test_bib_to_dc():
 def test_marc_xml_to_dc_xml():
     marc_record = open(str(Path(__file__).parent / "data/example_marc.xml"), "rb").read()
     record = open(str(Path(__file__).parent / "data/example_dc.xml"), "rb").read()
-    assert etree.tostring(marc_xml_to_dc_xml(etree.fromstring(marc_record))) == record
\ No newline at end of file
+    assert etree.tostring(marc_xml_to_dc_xml(etree.fromstring(marc_record))) == record
+
+def test_get_xml_resource_is_cached():
+    assert get_xml_resource(MARC2DC_XSLT) is get_xml_resource(MARC2DC_XSLT)
+    assert get_xml_resource(MARC21_XSD) is get_xml_resource(MARC21_XSD)
+    assert isinstance(get_xml_resource(MARC21_XSD), etree.XMLSchema)
+
+def test_get_xml_resource_recompiles_when_modified(mocker):
+    transform = get_xml_resource(MARC2DC_XSLT)
+    mocker.patch('dspaceq.tasks.utils.os.path.getmtime', return_value=0)
+    assert get_xml_resource(MARC2DC_XSLT) is not transform
+
+def test_reload_xml_resources():
+    transform = get_xml_resource(MARC2DC_XSLT)
+    schema = get_xml_resource(MARC21_XSD)
+    reload_xml_resources()
+    assert get_xml_resource(MARC2DC_XSLT) is not transform
+    assert get_xml_resource(MARC21_XSD) is not schema
+
+def test_get_xml_timings():
+    marc_record = open(str(Path(__file__).parent / "data/example_marc.xml"), "rb").read()
+    reload_xml_resources()
+    before = get_xml_timings()[MARC2DC_XSLT]
+    marc_xml_to_dc_xml(etree.fromstring(marc_record))
+    timings = get_xml_timings()
+    assert timings[MARC2DC_XSLT]["apply"]["count"] == before["apply"]["count"] + 1
+    assert timings[MARC2DC_XSLT]["compile"]["count"] == before["compile"]["count"] >= 1
+    assert get_stage_totals()["xslt"]["count"] == timings[MARC2DC_XSLT]["apply"]["count"]  # one timing system
+
+
+def test_download_s3_bags(s3_test_bucket, tmpdir):
+    bucket = os.getenv('DEFAULT_BUCKET')
+    bags = {}
+    for bag in ['bag_one', 'bag_two', 'empty_bag']:
+        bag_dir = tmpdir / bag
+        bag_dir.mkdir()
+        bags[str(bag_dir)] = []
+    for index in range(3):
+        for bag in ['bag_one', 'bag_two']:
+            key = 'private/shareok/{0}/data/file_{1}.pdf'.format(bag, index)
+            s3_test_bucket.put_object(Bucket=bucket, Key=key, Body='{0} {1}'.format(bag, index))
+            bags[str(tmpdir / bag)].append(key)
+    completed = list(download_s3_bags(s3_test_bucket, bucket, bags, max_workers=2, per_bag=1))
+    assert sorted(completed) == sorted(bags)
+    assert completed[0] == str(tmpdir / 'empty_bag')
+    assert (tmpdir / 'bag_two' / 'file_2.pdf').read() == 'bag_two 2'
+
+def test_download_s3_bags_shared_executor(tmpdir):
+    s3_client = Mock()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        for bag in ['bag_one', 'bag_two']:
+            bags = {str(tmpdir / bag): ['private/shareok/{0}/data/file.pdf'.format(bag)]}
+            assert list(download_s3_bags(s3_client, 'bucket', bags, executor=executor)) == list(bags)
+        executor.submit(lambda: None).result()  # left running for the other callers
+    assert s3_client.download_file.call_count == 2
+
+def test_download_s3_bags_shared_executor_failure(tmpdir, mocker):
+    mock_error = mocker.patch('dspaceq.tasks.utils.logging.error')
+    active = []
+
+    def download_file(bucket, key, filename, **kwargs):
+        active.append(key)
+        try:
+            if not key.endswith('file_0.pdf'):
+                time.sleep(0.3)
+            if key.endswith(('file_0.pdf', 'file_1.pdf')):
+                raise ClientError({"Error": {"Code": "NoSuchKey"}, "ResponseMetadata": {"HTTPStatusCode": 404}}, "GetObject")
+        finally:
+            active.remove(key)
+    s3_client = Mock()
+    s3_client.download_file.side_effect = download_file
+    bags = {str(tmpdir): ['private/shareok/bag/data/file_{0}.pdf'.format(index) for index in range(6)]}
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(ClientError):
+            list(download_s3_bags(s3_client, 'bucket', bags, per_bag=6, executor=executor))
+        assert active == []  # nothing is left writing into the failed bag
+        assert s3_client.download_file.call_count <= 3  # queued downloads were cancelled
+    # file_1 was already running, its failure is reported with the bag
+    also_failed = [call[0][0] for call in mock_error.call_args_list if 'also failed' in call[0][0]]
+    assert also_failed == ['Download into {0} also failed: An error occurred (NoSuchKey) when calling the '
+                           'GetObject operation: Unknown'.format(str(tmpdir))]
+
+def test_download_s3_bags_missing_object(s3_test_bucket, tmpdir, mocker):
+    mock_sleep = mocker.patch('dspaceq.tasks.utils.time.sleep')
+    bucket = os.getenv('DEFAULT_BUCKET')
+    bags = {str(tmpdir): ['private/shareok/missing/data/file.pdf']}
+    with pytest.raises(ClientError):
+        list(download_s3_bags(s3_test_bucket, bucket, bags, retries=3))
+    mock_sleep.assert_not_called()  # a 404 is not retried
+
+def test_download_s3_bags_retries_transient_errors(tmpdir, mocker):
+    mock_sleep = mocker.patch('dspaceq.tasks.utils.time.sleep')
+    s3_client = Mock()
+    s3_client.download_file.side_effect = [
+        RetriesExceededError(Exception("connection reset")),
+        ClientError({"Error": {"Code": "SlowDown"}, "ResponseMetadata": {"HTTPStatusCode": 503}}, "GetObject"),
+        None]
+    bags = {str(tmpdir): ['private/shareok/bag/data/file.pdf']}
+    assert list(download_s3_bags(s3_client, 'bucket', bags, retries=3)) == [str(tmpdir)]
+    assert s3_client.download_file.call_count == 3
+    assert mock_sleep.call_count == 2
+
+def test_download_s3_bags_staging_cache(s3_test_bucket, tmpdir, mocker):
+    bucket = os.getenv('DEFAULT_BUCKET')
+    cache = StagingCache(str(tmpdir / 'staging'), max_bytes=1024)
+    mocker.patch('dspaceq.tasks.utils.staging_cache', cache)
+    key = 'private/shareok/bag/data/file.pdf'
+    s3_test_bucket.put_object(Bucket=bucket, Key=key, Body='version one')
+    for attempt in ['first', 'retry']:
+        tmpdir.mkdir(attempt)
+        list(download_s3_bags(s3_test_bucket, bucket, {str(tmpdir / attempt): [key]}))
+        assert (tmpdir / attempt / 'file.pdf').read() == 'version one'
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['bytes_saved'] == len('version one')
+    # hardlinked rather than copied from the cache
+    assert os.stat(str(tmpdir / 'retry' / 'file.pdf')).st_nlink == 3
+
+    # a new version of the object has a new ETag
+    s3_test_bucket.put_object(Bucket=bucket, Key=key, Body='version two')
+    tmpdir.mkdir('changed')
+    list(download_s3_bags(s3_test_bucket, bucket, {str(tmpdir / 'changed'): [key]}))
+    assert (tmpdir / 'changed' / 'file.pdf').read() == 'version two'
+    assert cache.stats()['misses'] == 2
+    cache.clear()
+    assert not os.path.exists(str(tmpdir / 'staging'))
+
+def test_staging_cache_hit_evicted_by_another_worker(s3_test_bucket, tmpdir, mocker):
+    bucket = os.getenv('DEFAULT_BUCKET')
+    cache = StagingCache(str(tmpdir / 'staging'), max_bytes=1024)
+    key = 'private/shareok/bag/data/file.pdf'
+    s3_test_bucket.put_object(Bucket=bucket, Key=key, Body='pdf')
+    cache.fetch(s3_test_bucket, bucket, key, str(tmpdir / 'first.pdf'))
+    cached = os.path.join(cache.directory, os.listdir(cache.directory)[0])
+    link = StagingCache._link
+
+    def evicted_link(path, filename):
+        if path == cached and os.path.exists(path):
+            os.remove(path)  # evicted between the hit check and the link
+        link(path, filename)
+    mocker.patch.object(StagingCache, '_link', staticmethod(evicted_link))
+    cache.fetch(s3_test_bucket, bucket, key, str(tmpdir / 'retry.pdf'))
+    assert (tmpdir / 'retry.pdf').read() == 'pdf'
+    assert cache.stats()['hits'] == 0
+    assert cache.stats()['misses'] == 2
+
+def test_staging_cache_shared_with_dspace_group(s3_test_bucket, tmpdir, mocker):
+    mocker.patch('dspaceq.tasks.utils.grp.getgrnam').return_value.gr_gid = os.getgid()
+    bucket = os.getenv('DEFAULT_BUCKET')
+    cache = StagingCache(str(tmpdir / 'staging'), max_bytes=1024)
+    key = 'private/shareok/bag/data/file.pdf'
+    s3_test_bucket.put_object(Bucket=bucket, Key=key, Body='pdf')
+    previous = os.umask(0o077)
+    try:
+        cache.fetch(s3_test_bucket, bucket, key, str(tmpdir / 'file.pdf'))
+    finally:
+        os.umask(previous)
+    # a hardlink has the cached file's group and mode, not those of the ingest tree
+    assert stat.S_IMODE(os.stat(str(tmpdir / 'staging')).st_mode) == 0o2775
+    assert stat.S_IMODE(os.stat(str(tmpdir / 'file.pdf')).st_mode) == 0o664
+    assert os.stat(str(tmpdir / 'file.pdf')).st_gid == os.getgid()
+
+def test_staging_cache_removes_stale_partial_downloads(tmpdir):
+    cache = StagingCache(str(tmpdir), max_bytes=1024, part_max_age=3600)
+    for name in ['stale.1.2.part', 'stale.1.2.part.a1B2c3D4', 'running.1.3.part', 'cached']:
+        (tmpdir / name).write('x')
+    for name in ['stale.1.2.part', 'stale.1.2.part.a1B2c3D4']:
+        os.utime(str(tmpdir / name), (1000, 1000))
+    cache.evict()
+    assert sorted(os.listdir(str(tmpdir))) == ['cached', 'running.1.3.part']
+
+def test_staging_cache_evicts_least_recently_used(tmpdir):
+    cache = StagingCache(str(tmpdir), max_bytes=10)
+    for index, name in enumerate(['old', 'used', 'new']):
+        path = tmpdir / name
+        path.write('x' * 4)
+        os.utime(str(path), (1000 + index, 1000 + index))
+    os.utime(str(tmpdir / 'used'), None)
+    cache.evict()
+    assert sorted(os.listdir(str(tmpdir))) == ['new', 'used']
+
+
+def test_bib_record_cache_lru():
+    cache = BibRecordCache(maxsize=2, ttl=60)
+    cache.set("1", b"one")
+    cache.set("2", b"two")
+    assert cache.get("1") == b"one"
+    cache.set("3", b"three")  # evicts "2" the least recently used
+    assert cache.get("2") is None
+    assert cache.get("3") == b"three"
+    assert cache.stats()["hits"] == 2
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["size"] == 2
+
+def test_bib_record_cache_ttl(mocker):
+    cache = BibRecordCache(maxsize=2, ttl=60)
+    mock_time = mocker.patch('dspaceq.tasks.utils.time.time', return_value=1000)
+    cache.set("1", b"one")
+    mock_time.return_value = 1059
+    assert cache.get("1") == b"one"
+    mock_time.return_value = 1061
+    assert cache.get("1") is None
+    assert BibRecordCache(maxsize=2, ttl=0).get("1") is None
+
+def test_bib_record_cache_disk_backend(tmpdir):
+    cache = BibRecordCache(maxsize=2, ttl=60, backend="disk", directory=str(tmpdir / "cache"))
+    cache.set("1", b"one")
+    shared = BibRecordCache(maxsize=2, ttl=60, backend="disk", directory=str(tmpdir / "cache"))
+    assert shared.get("1") == b"one"
+    cache.invalidate("1")
+    assert BibRecordCache(maxsize=2, ttl=60, backend="disk", directory=str(tmpdir / "cache")).get("1") is None
+
+def test_bib_record_cache_mongo_backend(mock_celery_backend):
+    cache = BibRecordCache(maxsize=2, ttl=60, backend="mongo")
+    collection = mock_celery_backend.database.client.catalog.alma_bib_cache
+    collection.find.return_value = []
+    assert cache.get("1") is None
+    cache.set("1", b"one")
+    assert collection.replace_one.call_args[0][1]["bib_record"] == b"one"
+    cache.invalidate("1")
+    collection.delete_one.assert_called_with({"_id": "1"})
+    collection.create_index.assert_called_once_with("expires", expireAfterSeconds=0)
+
+def test_bib_record_cache_get_many(mock_celery_backend, mocker):
+    mocker.patch('dspaceq.tasks.utils.time.time', return_value=1000)
+    cache = BibRecordCache(maxsize=10, ttl=60, backend="mongo")
+    collection = mock_celery_backend.database.client.catalog.alma_bib_cache
+    collection.find.return_value = [{"_id": "2", "bib_record": b"two", "expires": datetime.datetime(1970, 1, 1, 0, 17, 30)}]
+    cache.set("1", b"one")
+    assert cache.get_many(["1", "2", "3"]) == {"1": b"one", "2": b"two"}
+    collection.find.assert_called_once()
+    assert collection.find.call_args[0][0]["_id"] == {"$in": ["2", "3"]}  # one query for the in memory misses
+    assert cache.get_many(["2"]) == {"2": b"two"}  # now held in memory
+    collection.find.assert_called_once()
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+def test_get_bib_records_cached(mock_alma_session):
+    mock_alma_session.request.return_value = Mock(status_code=200, content=_bibs_response("example_bib_record.xml"))
+    first = get_bib_records(["99263190402042", "99999999902042"])
+    second = get_bib_records(["99263190402042"])
+    assert second["99263190402042"] == first["99263190402042"]
+    assert mock_alma_session.request.call_count == 1
+    get_bib_records(["99999999902042"])  # errors are not cached
+    assert mock_alma_session.request.call_count == 2
+    get_bib_records(["99263190402042"], cache=False)
+    assert mock_alma_session.request.call_count == 3
+    assert bib_cache.stats()["hits"] == 1
+
+
+def test_token_bucket_rate(mocker):
+    mock_time = mocker.patch('dspaceq.tasks.utils.time')
+    mock_time.time.return_value = 1000
+    mock_time.sleep.side_effect = lambda seconds: setattr(mock_time.time, 'return_value', mock_time.time.return_value + seconds)
+    bucket = TokenBucket(rate=2)
+    for _ in range(4):
+        bucket.acquire()
+    assert mock_time.time.return_value == 1001  # burst of 2 then waits half a second per call
+
+def test_token_bucket_daily_limit():
+    bucket = TokenBucket(rate=100, daily_limit=2)
+    bucket.acquire()
+    bucket.acquire()
+    with pytest.raises(AlmaQuotaExceeded):
+        bucket.acquire()
+
+def test_token_bucket_shared_daily_limit():
+    calls = []
+    bucket = TokenBucket(rate=100, daily_limit=2, daily_counter=lambda: calls.append(1) or len(calls) + 1)
+    bucket.acquire()  # the other workers have made one call today
+    with pytest.raises(AlmaQuotaExceeded):
+        bucket.acquire()
+    with pytest.raises(AlmaQuotaExceeded):
+        bucket.acquire()
+    assert len(calls) == 2  # the shared count is not read again once exhausted
+
+def test_token_bucket_slow_rate(mocker):
+    mock_time = mocker.patch('dspaceq.tasks.utils.time')
+    mock_time.time.return_value = 1000
+    mock_time.sleep.side_effect = lambda seconds: setattr(mock_time.time, 'return_value', mock_time.time.return_value + seconds)
+    bucket = TokenBucket(rate=0.5)  # less than one call a second once divided between processes
+    bucket.acquire()
+    bucket.acquire()
+    assert mock_time.time.return_value == 1002
+
+def test_count_alma_request(mock_celery_backend):
+    usage = mock_celery_backend.database.client.catalog.alma_api_usage
+    usage.find_one_and_update.return_value = {"_id": "2019-09-01", "count": 7}
+    assert count_alma_request() == 7
+    assert usage.find_one_and_update.call_args[0][1] == {"$inc": {"count": 1}}
+    assert usage.find_one_and_update.call_args[1]["upsert"] is True
+
+def test_worker_processes(mocker):
+    app = mocker.patch('dspaceq.tasks.utils.app')
+    app.conf = {"worker_concurrency": 4}
+    assert worker_processes() == 4
+    app.conf["worker_pool"] = "threads"
+    assert worker_processes() == 1
+    assert worker_processes(PreforkPool, 3) == 3
+    assert worker_processes("solo", 3) == 1
+
+def test_alma_rate_limit_shared_by_worker_pool(mocker):
+    limiter = mocker.patch('dspaceq.tasks.utils.alma_rate_limiter', TokenBucket(10))
+    mocker.patch('dspaceq.tasks.utils.ALMA_RATE_LIMIT', 10)
+    # the concurrency given with celery worker -c
+    worker_init.send(sender=Mock(pool_cls=PreforkPool, concurrency=4))
+    assert limiter.rate == 2.5
+    assert limiter.capacity == 2.5
+    assert limiter.tokens == 2.5
+    worker_init.send(sender=Mock(pool_cls="threads", concurrency=4))
+    assert limiter.rate == 10
+
+def test_alma_request_retries(mock_alma_session, mocker):
+    mocker.patch('dspaceq.tasks.utils.ALMA_RETRIES', 2)
+    mock_sleep = mocker.patch('dspaceq.tasks.utils.time.sleep')
+    mock_alma_session.request.side_effect = [Mock(status_code=429), ConnectionError(), Mock(status_code=200)]
+    assert alma_request("PUT", "url", data="xml").status_code == 200
+    assert mock_alma_session.request.call_count == 3
+    assert mock_sleep.call_count == 2
+    mock_alma_session.request.side_effect = [Mock(status_code=503)] * 3
+    assert alma_request("GET", "url").status_code == 503
+    mock_alma_session.request.side_effect = None
+    mock_alma_session.request.return_value = Mock(status_code=400)
+    assert alma_request("GET", "url").status_code == 400
+    assert mock_alma_session.request.call_count == 7